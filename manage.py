@@ -6,6 +6,9 @@ import logging
 import os
 import signal
 import subprocess
+import sys
+import time
+from collections import Counter
 
 import click
 import gevent
@@ -55,6 +58,124 @@ class BotSupervisor(object):
             gevent.sleep(5)
 
 
+class WorkerSupervisor(object):
+    """
+    Runs each shard of task queues in its own `workers` process, restarting
+    any which exit, and logs the pools combined throughput. A child which exits
+    within `min_uptime` seconds of starting is restarted after a delay which
+    doubles with each quick exit in a row, up to `max_backoff` seconds.
+    """
+
+    def __init__(self, shards, worker_id='0', report_interval=60, min_uptime=60, max_backoff=300):
+        self.shards = shards
+        self.worker_id = worker_id
+        self.report_interval = report_interval
+        self.min_uptime = min_uptime
+        self.max_backoff = max_backoff
+        self.procs = {}
+        self.started = {}
+        self.quick_exits = Counter()
+        self.restart_at = {}
+        self.active = True
+        self.bind_signals()
+
+    def bind_signals(self):
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+
+    def handle_stop(self, signum, frame):
+        self.active = False
+        for proc in list(self.procs.values()):
+            proc.terminate()
+
+    def child_id(self, index):
+        return '{}.{}'.format(self.worker_id, index)
+
+    def start(self, index):
+        args = [sys.executable, 'manage.py', 'workers', '-w', self.child_id(index)]
+        for queue in self.shards[index]:
+            args += ['-q', queue]
+        self.procs[index] = subprocess.Popen(args)
+        self.started[index] = time.time()
+
+    def schedule_restart(self, index, returncode):
+        # A child which keeps dying straight away is probably crash looping
+        if time.time() - self.started[index] < self.min_uptime:
+            self.quick_exits[index] += 1
+        else:
+            self.quick_exits[index] = 0
+
+        delay = 0
+        if self.quick_exits[index]:
+            delay = min(self.max_backoff, 5 * 2 ** self.quick_exits[index])
+
+        print('Worker {} exited with {}, restarting in {}s'.format(self.child_id(index), returncode, delay))
+        self.restart_at[index] = time.time() + delay
+
+    def report(self, last):
+        from rowboat.tasks import get_worker_stats
+        from rowboat.util.stats import statsd
+
+        current = get_worker_stats([self.child_id(index) for index in range(len(self.shards))])
+
+        totals = Counter()
+        for worker_id, counts in list(current.items()):
+            for key, value in list(counts.items()):
+                previous = last.get(worker_id, {}).get(key, 0)
+                # Restarted children count from zero again
+                totals[key] += value - previous if value >= previous else value
+
+        for (task, name), value in sorted(totals.items()):
+            statsd.gauge('rowboat.tasks.throughput', value / float(self.report_interval), tags=['task:' + task, 'result:' + name])
+
+        completed = sum(value for (_, name), value in list(totals.items()) if name == 'completed')
+        failed = sum(value for (_, name), value in list(totals.items()) if name == 'failed')
+        print('{} workers, {:.2f} jobs/s ({} completed, {} failed in {}s)'.format(
+            len(current), completed / float(self.report_interval), completed, failed, self.report_interval))
+        return current
+
+    def run_forever(self):
+        for index in range(len(self.shards)):
+            self.start(index)
+
+        stats, report_at = {}, time.time() + self.report_interval
+        while self.active:
+            gevent.sleep(5)
+
+            for index, proc in list(self.procs.items()):
+                if not self.active:
+                    break
+
+                if index in self.restart_at:
+                    if time.time() >= self.restart_at[index]:
+                        del self.restart_at[index]
+                        self.start(index)
+                elif proc.poll() is not None:
+                    self.schedule_restart(index, proc.returncode)
+
+            if time.time() >= report_at:
+                try:
+                    stats = self.report(stats)
+                except Exception as e:
+                    print('Failed to collect worker stats: {}'.format(e))
+                report_at = time.time() + self.report_interval
+
+        for proc in list(self.procs.values()):
+            proc.wait()
+
+
+def shard_queues(queues, processes):
+    """
+    Spreads queues over processes, each queue getting at least one process.
+    """
+    if not queues or not processes:
+        return []
+
+    if processes >= len(queues):
+        return [[queues[index % len(queues)]] for index in range(processes)]
+    return [queues[index::processes] for index in range(processes)]
+
+
 @click.group()
 def cli():
     logging.getLogger().setLevel(logging.INFO)
@@ -86,9 +207,32 @@ def bot(env):
 
 
 @cli.command()
-@click.option('--worker-id', '-w', default=0)
-def workers(worker_id):
-    from rowboat.tasks import TaskWorker
+@click.option('--worker-id', '-w', default='0')
+@click.option('--processes', '-p', type=int, default=None, help='Run a pool of this many worker processes')
+@click.option('--queue', '-q', 'queues', multiple=True, help='Only run this queue, NAME=COUNT gives it dedicated processes')
+def workers(worker_id, processes, queues):
+    from rowboat.tasks import TaskWorker, load_tasks
+
+    dedicated = {}
+    shared = []
+    for queue in queues:
+        name, _, count = queue.partition('=')
+        if count:
+            dedicated[name] = int(count)
+        else:
+            shared.append(name)
+
+    if processes or dedicated:
+        # Queues without their own processes share the rest of the pool
+        if not shared:
+            shared = sorted(set(load_tasks()) - set(dedicated))
+
+        shards = shard_queues(shared, processes or 1)
+        for name, count in sorted(dedicated.items()):
+            shards += [[name]] * count
+
+        WorkerSupervisor(shards, worker_id=worker_id).run_forever()
+        return
 
     # Log things to file
     file_handler = logging.FileHandler('worker-%s.log' % worker_id)
@@ -100,7 +244,89 @@ def workers(worker_id):
         logging.getLogger(logname).setLevel(logging.INFO)
 
     init_db(ENV)
-    TaskWorker().run()
+    TaskWorker(worker_id, queues=shared or None).run()
+
+
+@cli.command('bench-censor')
+@click.option('--words', '-w', default=5000)
+@click.option('--messages', '-m', default=500)
+def bench_censor(words, messages):
+    """
+    Compares the censor word matcher against the alternation regex it replaced.
+    """
+    import random
+    import re
+    import string
+    import time
+
+    from rowboat.util.matcher import MultiMatcher
+
+    def random_word(low, high):
+        return ''.join(random.choice(string.ascii_lowercase) for _ in range(random.randint(low, high)))
+
+    blocked = [random_word(4, 10) for _ in range(words)]
+    tokens, blocked = blocked[:words // 10], blocked[words // 10:]
+    contents = [' '.join(random_word(2, 8) for _ in range(30)) for _ in range(messages)]
+
+    def bench(name, build, scan):
+        start = time.time()
+        obj = build()
+        built = time.time() - start
+
+        start = time.time()
+        found = sum(1 for content in contents if scan(obj, content))
+        scanned = time.time() - start
+
+        print('{}: built in {}ms, {} messages in {}ms ({} censored)'.format(
+            name, int(built * 1000), len(contents), int(scanned * 1000), found))
+
+    bench('regex', lambda: re.compile('({})'.format('|'.join(
+        list(map(re.escape, tokens)) + ['\\b{}\\b'.format(re.escape(k)) for k in blocked]
+    )), re.I), lambda obj, content: obj.findall(content))
+    bench('matcher', lambda: MultiMatcher(tokens, blocked), lambda obj, content: obj.findall(content))
+
+
+@cli.command('bench-levels')
+@click.option('--roles', '-r', default=50)
+@click.option('--members', '-m', default=10000)
+def bench_levels(roles, members):
+    """
+    Compares the compiled level index against looping over each member's roles.
+    """
+    import random
+    import time
+    from collections import namedtuple
+
+    from rowboat.util.levels import LevelIndex
+
+    Member = namedtuple('Member', ('id', 'roles'))
+
+    guild_roles = list(range(1, 250))
+    levels = {role: random.choice((10, 50, 100)) for role in random.sample(guild_roles, 10)}
+
+    # Members of large guilds share a handful of role combinations
+    role_sets = [random.sample(guild_roles, roles) for _ in range(200)]
+    population = [Member(1000 + idx, random.choice(role_sets)) for idx in range(members)]
+
+    def loop(member):
+        user_level = 0
+        for oid in member.roles:
+            if oid in levels and levels[oid] > user_level:
+                user_level = levels[oid]
+
+        if member.id in levels:
+            user_level = levels[member.id]
+        return user_level
+
+    def bench(name, get_level):
+        start = time.time()
+        for _ in range(5):
+            for member in population:
+                get_level(member)
+        print('{}: {} lookups in {}ms'.format(name, len(population) * 5, int((time.time() - start) * 1000)))
+
+    bench('loop', loop)
+    bench('index', LevelIndex(levels).get_level)
 
 
 @cli.command('add-global-admin')
@@ -108,8 +334,11 @@ def workers(worker_id):
 def add_global_admin(user_id):
     from rowboat.models.user import User
     from rowboat.redis import rdb
+    from rowboat.util.redis import RedisSet
     init_db(ENV)
-    rdb.sadd('global_admins', user_id)
+
+    # Published, so running bots pick it up straight away
+    RedisSet(rdb, 'global_admins', int, listen=False).add(int(user_id))
     user = User.get_id(user_id)
     user.update(admin=True)
     print('Ok, added {} as a global admin'.format(str(user))) # Not sure if I need to str here
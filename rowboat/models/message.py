@@ -10,12 +10,24 @@ from playhouse.postgres_ext import ArrayField, BinaryJSONField
 from rowboat import REV
 from rowboat.constants import WEB_URL
 from rowboat.models.user import User
-from rowboat.sql import ModelBase
+from rowboat.sql import BatchInserter, ModelBase
+from rowboat.tasks.delayed import DelayedQueue
 from rowboat.util import default_json
+from rowboat.util.cache import ExpiringCache
+from rowboat.util.stats import LatencyTracker
 
 EMOJI_RE = re.compile(r'<:.+:([0-9]+)>')
 
 
+def estimate_message_size(msg):
+    # Rough, but enough to bound the memory held by the message cache
+    return 512 + len(msg.content or '') + sum(map(len, msg.attachments or [])) + sum(map(len, msg.embeds or []))
+
+
+# Recently created messages, so edits and deletes don't need the database
+MESSAGE_CACHE = ExpiringCache('messages', 100000, 3600, max_bytes=64 * 1024 * 1024, sizeof=estimate_message_size)
+
+
 @ModelBase.register
 class Message(ModelBase):
     id = BigIntegerField(primary_key=True)
@@ -112,12 +124,14 @@ class Message(ModelBase):
         return q.execute()
 
     @staticmethod
-    def convert_message(obj):
+    def convert_message(obj, resolve_author=True):
+        # Without resolving the author the row only holds their ID, and they
+        #  must be stored before the row is inserted
         return {
             'id': obj.id,
             'channel_id': obj.channel_id,
             'guild_id': (obj.guild_id if obj.guild_id else None),
-            'author': User.from_disco_user(obj.author),
+            'author': User.from_disco_user(obj.author) if resolve_author else obj.author.id,
             'content': obj.with_proper_mentions,
             'timestamp': obj.timestamp,
             'edited_timestamp': obj.edited_timestamp,
@@ -128,6 +142,49 @@ class Message(ModelBase):
             'embeds': [json.dumps(i.to_dict(), default=default_json) for i in obj.embeds],
         }
 
+    @classmethod
+    def cache_message(cls, row, author=None):
+        msg = cls(**row)
+        if author:
+            # Built in memory, so caching never waits on the database
+            msg.author = User(user_id=author.id, username=author.username, avatar=author.avatar, bot=author.bot)
+        MESSAGE_CACHE.set(row['id'], msg)
+
+    @staticmethod
+    def get_cached(message_id):
+        return MESSAGE_CACHE.get(message_id)
+
+    @staticmethod
+    def update_cached(obj):
+        msg = MESSAGE_CACHE.peek(obj.id)
+        if not msg or not obj.edited_timestamp:
+            return
+
+        msg.edited_timestamp = obj.edited_timestamp
+        msg.num_edits += 1
+        msg.mentions = list(obj.mentions.keys())
+
+        if obj.content is not None:
+            msg.content = obj.with_proper_mentions
+            msg.emojis = list(map(int, EMOJI_RE.findall(obj.content)))
+
+        if obj.attachments is not None:
+            msg.attachments = [i.url for i in list(obj.attachments.values())]
+
+        if obj.embeds is not None:
+            msg.embeds = [json.dumps(i.to_dict(), default=default_json) for i in obj.embeds]
+
+        # Sets again so the cache accounts for the new size
+        MESSAGE_CACHE.set(obj.id, msg)
+
+    @staticmethod
+    def mark_cached_deleted(ids):
+        # Deleted messages are kept around, modlog still wants their contents
+        for message_id in ids:
+            msg = MESSAGE_CACHE.peek(message_id)
+            if msg:
+                msg.deleted = True
+
     @classmethod
     def for_channel(cls, channel):
         return cls.select().where(cls.channel_id == channel.id)
@@ -362,6 +419,10 @@ class StarboardEntry(ModelBase):
         ).execute()
 
 
+# Reminders, keyed by message ID and due when they should be sent
+REMINDERS = DelayedQueue('reminders')
+
+
 @ModelBase.register
 class Reminder(ModelBase):
     message_id = BigIntegerField(primary_key=True)
@@ -415,8 +476,8 @@ class Command(ModelBase):
         )
 
     @classmethod
-    def track(cls, event, command, exception=False):
-        return cls.create(
+    def track(cls, event, command, exception=False, duration=None):
+        row = dict(
             message_id=event.message.id,
             plugin=command.plugin.name,
             command=command.name,
@@ -424,3 +485,18 @@ class Command(ModelBase):
             success=not exception,
             traceback=traceback.format_exc() if exception else None,
         )
+
+        # Written in batches by the CorePlugin, rather than inline with the command
+        COMMAND_BATCH.add(row)
+
+        if duration is not None:
+            COMMAND_LATENCY.record((command.plugin.name, command.name), duration)
+
+        return cls(**row)
+
+
+# Pending command usage, flushed by the CorePlugin
+COMMAND_BATCH = BatchInserter(Command)
+
+# Recent latencies for each (plugin, command)
+COMMAND_LATENCY = LatencyTracker()
@@ -0,0 +1,8 @@
+from rowboat.models.migrations import Migrate
+
+
+@Migrate.always()
+def add_messages_channel_id_index(m):
+    # Finding the newest stored message in a channel (gap recovery). Built
+    #  concurrently, the messages table is too large to lock while it's built.
+    m.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS messages_channel_id_id ON messages (channel_id, id);', transaction=False)
@@ -45,9 +45,17 @@ class Migrate(object):
 
         print('Executing {} raw queries'.format(len(self.raw_actions)))
         conn = database.obj.connection()
-        for query, args in self.raw_actions:
-            with conn.cursor() as cur:
-                cur.execute(query, args)
+        for query, args, transaction in self.raw_actions:
+            # Some statements (e.g. CREATE INDEX CONCURRENTLY) refuse to run in a
+            #  transaction, and autocommit can only be switched outside of one
+            conn.commit()
+            autocommit = conn.autocommit
+            conn.autocommit = autocommit or not transaction
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(query, args)
+            finally:
+                conn.autocommit = autocommit
             conn.commit()
 
     def add_columns(self, table, *fields):
@@ -65,8 +73,8 @@ class Migrate(object):
         for field in fields:
             self.actions.append(self.m.add_not_null(table._meta.db_table, field.name))
 
-    def execute(self, query, params=None):
-        self.raw_actions.append((query, params or []))
+    def execute(self, query, params=None, transaction=True):
+        self.raw_actions.append((query, params or [], transaction))
 
     def backfill_column(self, table, old_columns, new_columns, pkeys=None, cast_funcs=None):
         total = table.select().count()
@@ -8,8 +8,16 @@ from playhouse.postgres_ext import BinaryJSONField
 
 from rowboat.plugins.modlog.core import Actions
 from rowboat.sql import ModelBase
+from rowboat.tasks.delayed import DelayedQueue
+from rowboat.util.cache import LRUCache
 from rowboat.util.input import human_time
 
+# Recently seen users, used to skip the database when nothing has changed
+USER_CACHE = LRUCache('users', 100000)
+
+# Temporary infractions, keyed by ID and due when they expire
+INFRACTION_EXPIRY = DelayedQueue('infractions')
+
 
 @ModelBase.register
 class User(ModelBase):
@@ -64,6 +72,10 @@ class User(ModelBase):
     @classmethod
     def from_disco_user(cls, user, should_update=True):
         # DEPRECATED
+        obj = USER_CACHE.get(user.id)
+        if obj and (not should_update or (obj.username, obj.avatar) == (user.username, user.avatar)):
+            return obj
+
         obj, _ = cls.get_or_create(
             user_id=user.id,
             defaults={
@@ -84,8 +96,21 @@ class User(ModelBase):
             if updates:
                 cls.update(**updates).where(User.user_id == user.id).execute()
 
+                obj.username = user.username
+                obj.avatar = user.avatar
+
+        USER_CACHE.set(user.id, obj)
         return obj
 
+    @staticmethod
+    def invalidate_cache(user_id):
+        USER_CACHE.pop(user_id)
+
+    @staticmethod
+    def is_cached(user_id, username, avatar):
+        obj = USER_CACHE.get(user_id)
+        return bool(obj) and (obj.username, obj.avatar) == (username, avatar)
+
     def get_avatar_url(self, fmt='webp', size=1024):
         if not self.avatar:
             return None
@@ -188,7 +213,7 @@ class Infraction(ModelBase):
                 event.channel.send_message('I do not have permission to role this member. Action cancelled.')
                 return
 
-        cls.create(
+        inf = cls.create(
             guild_id=event.guild.id,
             user_id=member.user.id,
             actor_id=event.author.id,
@@ -196,6 +221,7 @@ class Infraction(ModelBase):
             reason=reason,
             expires_at=expires_at,
             metadata={'role': role_id})
+        INFRACTION_EXPIRY.schedule(inf.id, expires_at)
 
     @classmethod
     def kick(cls, plugin, event, member, reason):
@@ -268,7 +294,7 @@ class Infraction(ModelBase):
             expires=expires_at,
         )
 
-        cls.create(
+        inf = cls.create(
             guild_id=member.guild_id,
             user_id=member.user.id,
             actor_id=event.author.id,
@@ -276,6 +302,7 @@ class Infraction(ModelBase):
             reason=reason,
             expires_at=expires_at,
             messaged=msg_status)
+        INFRACTION_EXPIRY.schedule(inf.id, expires_at)
 
     @classmethod
     def softban(cls, plugin, event, member, reason):
@@ -439,7 +466,7 @@ class Infraction(ModelBase):
             expires=expires_at,
         )
 
-        cls.create(
+        inf = cls.create(
             guild_id=event.guild.id,
             user_id=member.user.id,
             actor_id=event.author.id,
@@ -448,6 +475,7 @@ class Infraction(ModelBase):
             expires_at=expires_at,
             metadata={'role': admin_config.mute_role},
             messaged=msg_status)
+        INFRACTION_EXPIRY.schedule(inf.id, expires_at)
 
     @classmethod
     def send_message(cls, action, user, guild, reason=None, expires_at=None):
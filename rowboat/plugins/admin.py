@@ -23,17 +23,17 @@ from rapidfuzz import fuzz
 from rowboat.constants import GREEN_TICK_EMOJI, GREEN_TICK_EMOJI_ID, RED_TICK_EMOJI, RED_TICK_EMOJI_ID
 from rowboat.models.guild import GuildBan, GuildEmoji, GuildMemberBackup, GuildVoiceSession
 from rowboat.models.message import Message, MessageArchive, Reaction
-from rowboat.models.user import Infraction, User
+from rowboat.models.user import INFRACTION_EXPIRY, Infraction, User
 from rowboat.plugins import CommandFail, CommandSuccess
 from rowboat.plugins import RowboatPlugin as Plugin
 from rowboat.plugins.modlog import Actions
 from rowboat.redis import rdb
+from rowboat.tasks.delayed import DelayedRunner
 from rowboat.types import DictField, Field, ListField, SlottedModel, snowflake
 from rowboat.types.plugin import PluginConfig
 from rowboat.util.images import get_dominant_colors_user
 from rowboat.util.input import parse_duration
-from rowboat.util.time import timestamp_now
-from rowboat.util.timing import Eventual
+from rowboat.util.time import as_unix, timestamp_now
 
 EMOJI_RE = re.compile(r'<:[a-zA-Z0-9_]+:([0-9]+)>')
 
@@ -104,99 +104,104 @@ class AdminPlugin(Plugin):
         super(AdminPlugin, self).load(ctx)
 
         self.cleans = {}
-        self.inf_task = Eventual(self.clear_infractions)
+        self.inf_runner = DelayedRunner(INFRACTION_EXPIRY, self.clear_infraction)
+        self.spawn(self.inf_runner.run)
         self.spawn_later(5, self.queue_infractions)
 
         self.unlocked_roles = {}
         self.role_debounces = {}
 
+    def unload(self, ctx):
+        self.inf_runner.stop()
+        super(AdminPlugin, self).unload(ctx)
+
     def queue_infractions(self):
-        next_infraction = list(Infraction.select().where(
+        # Picks up anything created before the expiry queue existed, or by another process. Anything
+        #  which gave up is revived as well, since it's still active (e.g. its guild wasn't loaded back then).
+        pending = list(Infraction.select(Infraction.id, Infraction.expires_at).where(
             (Infraction.active == 1) &
             (~(Infraction.expires_at >> None))
-        ).order_by(Infraction.expires_at.asc()).limit(1))
+        ).tuples())
+
+        self.log.info('[INF] Scheduling %s active infractions for expiry', len(pending))
+        INFRACTION_EXPIRY.schedule_many(pending, revive=True)
 
-        if not next_infraction:
-            self.log.info('[INF] Not awaiting any infractions..')
+    def clear_infraction(self, infraction_id):
+        try:
+            item = Infraction.get(id=int(infraction_id))
+        except Infraction.DoesNotExist:
             return
 
-        self.log.info('[INF] Waiting until %s for #%s', next_infraction[0].expires_at, next_infraction[0].id)
-        self.inf_task.set_next_schedule(next_infraction[0].expires_at)
+        if not item.active or not item.expires_at:
+            return
 
-    def clear_infractions(self):
-        expired = list(Infraction.select().where(
-            (Infraction.active == 1) &
-            (Infraction.expires_at < datetime.now(timezone.utc))
-        ))
+        # The duration was changed since this was scheduled
+        if as_unix(item.expires_at) > timestamp_now():
+            INFRACTION_EXPIRY.schedule(item.id, item.expires_at)
+            return
 
-        self.log.info('[INF] Trying to clear %s expired infractions', len(expired))
-
-        for item in expired:
-            guild = self.state.guilds.get(item.guild_id)
-            if not guild:
-                self.log.warning('[INF] Could not remove #%s! Guild does not exist.', item.id)
-                continue
-
-            # TODO: hacky
-            type_ = {i.index: i for i in Infraction.Types.attrs}[item.type_]
-            if type_ == Infraction.Types.TEMPBAN:
-                self.call(
-                    'ModLogPlugin.create_debounce',
-                    guild.id,
-                    ['GuildBanRemove'],
-                    user_id=item.user_id,
-                )
-
-                try: 
-                    guild.delete_ban(item.user_id)
-                except:
-                    pass # no need, we can keep going :)
-
-                self.call(
-                    'ModLogPlugin.log_action_ext',
-                    Actions.MEMBER_TEMPBAN_EXPIRE,
-                    guild.id,
-                    user_id=item.user_id,
-                    user=str(self.state.users.get(item.user_id) or item.user_id),
-                    inf=item
-                )
-            elif type_ == Infraction.Types.TEMPMUTE or Infraction.Types.TEMPROLE:
-                member = guild.get_member(item.user_id)
-                if member:
-                    if item.metadata['role'] in member.roles:
-                        self.call(
-                            'ModLogPlugin.create_debounce',
-                            guild.id,
-                            ['GuildMemberUpdate'],
-                            user_id=item.user_id,
-                            role_id=item.metadata['role'],
-                        )
-
-                        member.remove_role(item.metadata['role'])
-
-                        self.call(
-                            'ModLogPlugin.log_action_ext',
-                            Actions.MEMBER_TEMPMUTE_EXPIRE,
-                            guild.id,
-                            member=member,
-                            inf=item
-                        )
-                else:
-                    GuildMemberBackup.remove_role(
-                        item.guild_id,
-                        item.user_id,
-                        item.metadata['role'])
-            else:
-                self.log.warning('[INF] failed to clear infraction %s, type is invalid %s', item.id, item.type_)
-                continue
+        self.log.info('[INF] Clearing expired infraction #%s', item.id)
+
+        guild = self.state.guilds.get(item.guild_id)
+        if not guild:
+            # Retried (a limited number of times), we may not have received the guild yet
+            raise Exception('Could not remove #{}! Guild does not exist.'.format(item.id))
+
+        # TODO: hacky
+        type_ = {i.index: i for i in Infraction.Types.attrs}[item.type_]
+        if type_ == Infraction.Types.TEMPBAN:
+            self.call(
+                'ModLogPlugin.create_debounce',
+                guild.id,
+                ['GuildBanRemove'],
+                user_id=item.user_id,
+            )
+
+            try: 
+                guild.delete_ban(item.user_id)
+            except:
+                pass # no need, we can keep going :)
+
+            self.call(
+                'ModLogPlugin.log_action_ext',
+                Actions.MEMBER_TEMPBAN_EXPIRE,
+                guild.id,
+                user_id=item.user_id,
+                user=str(self.state.users.get(item.user_id) or item.user_id),
+                inf=item
+            )
+        elif type_ == Infraction.Types.TEMPMUTE or Infraction.Types.TEMPROLE:
+            member = guild.get_member(item.user_id)
+            if member:
+                if item.metadata['role'] in member.roles:
+                    self.call(
+                        'ModLogPlugin.create_debounce',
+                        guild.id,
+                        ['GuildMemberUpdate'],
+                        user_id=item.user_id,
+                        role_id=item.metadata['role'],
+                    )
 
-            # TODO: n+1
-            item.active = False
-            item.save()
+                    member.remove_role(item.metadata['role'])
+
+                    self.call(
+                        'ModLogPlugin.log_action_ext',
+                        Actions.MEMBER_TEMPMUTE_EXPIRE,
+                        guild.id,
+                        member=member,
+                        inf=item
+                    )
+            else:
+                GuildMemberBackup.remove_role(
+                    item.guild_id,
+                    item.user_id,
+                    item.metadata['role'])
+        else:
+            self.log.warning('[INF] failed to clear infraction %s, type is invalid %s', item.id, item.type_)
+            return
 
-        # Wait a few seconds to backoff from a possible bad loop, and requeue new infractions
-        gevent.sleep(5)
-        self.queue_infractions()
+        item.active = False
+        item.save()
 
     def restore_user(self, event, member):
         try:
@@ -485,7 +490,7 @@ class AdminPlugin(Plugin):
 
         inf.expires_at = expires_dt
         inf.save()
-        self.queue_infractions()
+        INFRACTION_EXPIRY.schedule(inf.id, inf.expires_at)
 
         if converted:
             raise CommandSuccess('Ok, I\'ve made that infraction temporary, it will now expire on {}'.format(
@@ -621,7 +626,6 @@ class AdminPlugin(Plugin):
             if duration:
                 # Create the infraction
                 Infraction.tempmute(self, event, member, reason, duration)
-                self.queue_infractions()
 
                 if event.config.confirm_actions:
                     event.msg.reply(maybe_string(
@@ -671,7 +675,6 @@ class AdminPlugin(Plugin):
 
         expire_dt = parse_duration(duration)
         Infraction.temprole(self, event, member, role_id, reason, expire_dt)
-        self.queue_infractions()
 
         if event.config.confirm_actions:
             event.msg.reply(maybe_string(
@@ -875,7 +878,6 @@ class AdminPlugin(Plugin):
             self.can_act_on(event, member.id)
             expires_dt = parse_duration(duration)
             Infraction.tempban(self, event, member, reason, expires_dt)
-            self.queue_infractions()
             if event.config.confirm_actions:
                 event.msg.reply(maybe_string(
                     reason,
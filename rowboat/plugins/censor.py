@@ -1,21 +1,24 @@
 import json
-import re
-import urllib.parse
-from urllib.parse import unquote
+import time
 
+from disco.api.http import APIException
 from disco.types.base import cached_property
 from disco.types.channel import ChannelType
 from disco.util.sanitize import S
+from gevent.event import AsyncResult
 
-from rowboat.constants import INVITE_LINK_RE, URL_RE
-from rowboat.models.message import Message
 from rowboat.plugins import RowboatPlugin as Plugin
 from rowboat.plugins.modlog import Actions
 from rowboat.redis import rdb
 from rowboat.types import ChannelField, DictField, Field, ListField, SlottedModel, lower, snowflake
 from rowboat.types.plugin import PluginConfig
-from rowboat.util.stats import timed
-from rowboat.util.zalgo import ZALGO_RE
+from rowboat.util.cache import LRUCache
+from rowboat.util.matcher import MultiMatcher
+from rowboat.util.scan import MessageScan
+from rowboat.util.stats import increment, timed
+
+# Unknown Invite
+INVITE_UNKNOWN_CODE = 10006
 
 
 class CensorReason:
@@ -43,11 +46,8 @@ class CensorSubConfig(SlottedModel):
     blocked_tokens = ListField(lower, default=[])
 
     @cached_property
-    def blocked_re(self):
-        return re.compile('({})'.format('|'.join(
-            list(map(re.escape, self.blocked_tokens)) +
-            ['\\b{}\\b'.format(re.escape(k)) for k in self.blocked_words]
-        )), re.I)
+    def blocked_matcher(self):
+        return MultiMatcher.get(self.blocked_tokens, self.blocked_words)
 
 
 class CensorConfig(PluginConfig):
@@ -91,46 +91,108 @@ class Censorship(Exception):
             return '...unsure why this message was censored. Please notify my developer.'
 
 
+class InviteCache(object):
+    """
+    Resolves invite codes to guild info through an in-process LRU, then Redis,
+    then the API. Unknown invites are cached for a shorter period, and
+    concurrent lookups of the same code share a single API call.
+    """
+    TTL = 43200
+    NEGATIVE_TTL = 900
+    LOCAL_TTL = 300
+
+    def __init__(self, api, max_size=10000):
+        self.api = api
+        self._local = LRUCache('invites', max_size)
+        self._pending = {}
+
+    def get(self, code):
+        entry = self._local.get(code)
+        if entry and entry[0] > time.time():
+            increment('rowboat.censor.invites', tags={'source': 'local'})
+            return entry[1]
+
+        pending = self._pending.get(code)
+        if pending:
+            increment('rowboat.censor.invites', tags={'source': 'coalesced'})
+            return pending.get()
+
+        result = self._pending[code] = AsyncResult()
+        try:
+            info = self._resolve(code)
+        except Exception as e:
+            result.set_exception(e)
+            raise
+        else:
+            result.set(info)
+            return info
+        finally:
+            del self._pending[code]
+
+    def _resolve(self, code):
+        key = 'inv:{}'.format(code)
+
+        cached = rdb.get(key)
+        if cached is not None:
+            increment('rowboat.censor.invites', tags={'source': 'redis'})
+            info = json.loads(cached)
+            self._set_local(code, info)
+            return info
+
+        increment('rowboat.censor.invites', tags={'source': 'api'})
+        try:
+            obj = self.api.invites_get(code)
+        except APIException as e:
+            if e.code != INVITE_UNKNOWN_CODE:
+                return
+
+            rdb.setex(key, self.NEGATIVE_TTL, json.dumps(None))
+            self._set_local(code, None)
+            return
+        except Exception:
+            return
+
+        info = {
+            'id': obj.guild.id,
+            'name': obj.guild.name,
+            'icon': obj.guild.icon
+        }
+
+        rdb.setex(key, self.TTL, json.dumps(info))
+        self._set_local(code, info)
+        return info
+
+    def _set_local(self, code, info):
+        self._local.set(code, (time.time() + self.LOCAL_TTL, info))
+
+
 @Plugin.with_config(CensorConfig)
 class CensorPlugin(Plugin):
+    def load(self, ctx):
+        super(CensorPlugin, self).load(ctx)
+        self.invites = InviteCache(self.client.api)
+
     def compute_relevant_configs(self, event, author):
         if event.channel_id in event.config.channels:
             yield event.config.channels[event.channel.id]
 
         if event.config.levels:
-            user_level = int(self.bot.plugins.get('CorePlugin').get_level(event.guild, author))
+            user_level = int(self.bot.plugins.get('CorePlugin').get_context(event).get_level(author))
 
             for level, config in list(event.config.levels.items()):
                 if user_level <= level:
                     yield config
 
     def get_invite_info(self, code):
-        if rdb.exists('inv:{}'.format(code)):
-            return json.loads(rdb.get('inv:{}'.format(code)))
-
-        try:
-            obj = self.client.api.invites_get(code)
-        except:
-            return
-
-        obj = {
-            'id': obj.guild.id,
-            'name': obj.guild.name,
-            'icon': obj.guild.icon
-        }
-
-        # Cache for 12 hours
-        rdb.setex('inv:{}'.format(code), 43200, json.dumps(obj))
-        return obj
+        return self.invites.get(code)
 
     @Plugin.listen('MessageUpdate')
     def on_message_update(self, event):
         if event.message.author.bot or not event.content:
             return
 
-        try:
-            msg = Message.get(id=event.id)
-        except Message.DoesNotExist:
+        msg = self.get_safe_plugin('SQLPlugin').get_message(event.id)
+        if not msg:
             self.log.warning('Not censoring MessageUpdate for id %s, %s, no stored message', event.channel_id, event.id)
             return
 
@@ -155,22 +217,25 @@ class CensorPlugin(Plugin):
         if not configs:
             return
 
+        # Every config is evaluated against the same scan of the message
+        scan = MessageScan.of(event)
+
         tags = {'guild_id': event.guild.id, 'channel_id': event.channel.id}
         with timed('rowboat.plugin.censor.duration', tags=tags):
             try:
                 for config in configs:
                     if config.filter_zalgo:
-                        self.filter_zalgo(event, config)
+                        self.filter_zalgo(event, config, scan)
 
                     if config.filter_invites:
-                        self.filter_invites(event, config)
+                        self.filter_invites(event, config, scan)
 
                     if config.filter_domains:
                         if str(event.channel.id) not in config.domain_filter_ignored_channels:
-                            self.filter_domains(event, config)
+                            self.filter_domains(event, config, scan)
 
                     if config.blocked_words or config.blocked_tokens:
-                        self.filter_blocked_words(event, config)
+                        self.filter_blocked_words(event, config, scan)
             except Censorship as c:
                 self.call(
                     'ModLogPlugin.create_debounce',
@@ -191,18 +256,15 @@ class CensorPlugin(Plugin):
                 except:
                     self.log.exception('Failed to delete censored message: ')
 
-    def filter_zalgo(self, event, config):
-        s = ZALGO_RE.search(event.content)
-        if s:
+    def filter_zalgo(self, event, config, scan):
+        if scan.zalgo_position is not None:
             raise Censorship(CensorReason.ZALGO, event, ctx={
-                'position': s.start()
+                'position': scan.zalgo_position
             })
 
-    def filter_invites(self, event, config):
-        invites = INVITE_LINK_RE.findall(unquote(event.content))
-
-        for _, invite in invites:
-            invite_info = self.get_invite_info(invite)
+    def filter_invites(self, event, config, scan):
+        for invite in scan.invites:
+            invite_info = scan.get_invite_info(invite, self.get_invite_info)
 
             need_whitelist = (
                     config.invites_guild_whitelist or
@@ -229,36 +291,32 @@ class CensorPlugin(Plugin):
                     'guild': invite_info,
                 })
 
-    def filter_domains(self, event, config):
-        urls = URL_RE.findall(URL_RE.sub('', event.content))
-
-        for url in urls:
-            try:
-                parsed = urllib.parse.urlparse(url)
-            except:
-                continue
-
-            if config.domains_whitelist and parsed.netloc.lower() not in config.domains_whitelist:
-                raise Censorship(CensorReason.DOMAIN, event, ctx={
-                    'hit': 'whitelist',
-                    'url': url,
-                    'domain': parsed.netloc,
-                })
-            elif config.domains_blacklist and parsed.netloc.lower() in config.domains_blacklist:
-                raise Censorship(CensorReason.DOMAIN, event, ctx={
-                    'hit': 'blacklist',
-                    'url': url,
-                    'domain': parsed.netloc
-                })
+    def filter_domains(self, event, config, scan):
+        for url, domain in scan.domains:
+            if config.domains_whitelist:
+                if domain not in config.domains_whitelist:
+                    raise Censorship(CensorReason.DOMAIN, event, ctx={
+                        'hit': 'whitelist',
+                        'url': url,
+                        'domain': domain,
+                    })
+            elif config.domains_blacklist:
+                if domain in config.domains_blacklist:
+                    raise Censorship(CensorReason.DOMAIN, event, ctx={
+                        'hit': 'blacklist',
+                        'url': url,
+                        'domain': domain
+                    })
             else:
+                # Without either list, no links are allowed at all
                 raise Censorship(CensorReason.DOMAIN, event, ctx={
                     'hit': 'other',
                     'url': url,
-                    'domain': parsed.netloc
+                    'domain': domain
                 })
 
-    def filter_blocked_words(self, event, config):
-        blocked_words = config.blocked_re.findall(event.content)
+    def filter_blocked_words(self, event, config, scan):
+        blocked_words = scan.find_blocked(config.blocked_matcher)
 
         if blocked_words:
             raise Censorship(CensorReason.WORD, event, ctx={
@@ -6,6 +6,7 @@ import os
 import pprint
 import signal
 import time
+from collections import Counter
 from datetime import datetime, timedelta, timezone
 
 import gevent
@@ -22,7 +23,7 @@ from disco.util.snowflake import to_datetime
 from rowboat import ENV, REV
 from rowboat.constants import GREEN_TICK_EMOJI, GREEN_TICK_EMOJI_ID, RED_TICK_EMOJI, RED_TICK_EMOJI_ID, ROWBOAT_CONTROL_CHANNEL, ROWBOAT_GUILD_ID, ROWBOAT_USER_ROLE_ID, WEB_URL
 from rowboat.models.guild import Guild, GuildBan
-from rowboat.models.message import Command, Message
+from rowboat.models.message import COMMAND_BATCH, Command, Message
 from rowboat.models.user import Infraction
 from rowboat.plugins import CommandFail, CommandResponse, CommandSuccess
 from rowboat.plugins import RowboatPlugin as Plugin
@@ -30,6 +31,10 @@ from rowboat.plugins.modlog import Actions
 from rowboat.redis import rdb
 from rowboat.sql import init_db
 from rowboat.util import LocalProxy
+from rowboat.util.commands import CommandMatcher, compile_prefixes
+from rowboat.util.context import EventContext
+from rowboat.util.levels import LevelIndex
+from rowboat.util.redis import RedisSet
 from rowboat.util.time import DiscordFormatting, as_discord, to_datetime_aware
 from rowboat.util.stats import timed
 
@@ -42,6 +47,36 @@ Speedboat is a moderation and utilitarian bot built for large Discord servers.
 GUILDS_WAITING_SETUP_KEY = 'gws'
 
 
+class GuildDispatch(object):
+    """
+    A guild's config along with the config of each plugin it enables (and its
+    compiled levels), so events can be routed (or dropped) without
+    re-resolving the config.
+    """
+
+    def __init__(self, guild):
+        self.guild = guild
+        self.config = guild.get_config()
+        self.levels = LevelIndex(self.config.levels if self.config else None)
+        self.prefixes = compile_prefixes(self.config.commands if self.config else None)
+        self.plugins = {}
+
+    def get_plugin_config(self, plugin):
+        try:
+            return self.plugins[plugin.name]
+        except KeyError:
+            pass
+
+        plugin_config = None
+        if self.config:
+            if not hasattr(plugin, 'WHITELIST_FLAG') or int(plugin.WHITELIST_FLAG) in self.guild.whitelist:
+                plugin_name = plugin.name.lower().replace('plugin', '')
+                plugin_config = getattr(self.config.plugins, plugin_name, None) or None
+
+        self.plugins[plugin.name] = plugin_config
+        return plugin_config
+
+
 class CorePlugin(Plugin):
     def load(self, ctx):
         init_db(ENV)
@@ -49,7 +84,17 @@ class CorePlugin(Plugin):
         self.startup = ctx.get('startup', datetime.now(timezone.utc))
         self.guilds = ctx.get('guilds', {})
 
-        self.emitter = Emitter()
+        # Guild id -> GuildDispatch, rebuilt whenever a guild is loaded or its config changes
+        self.dispatch = {}
+        self.dispatch_counts = Counter()
+
+        # Mirrored from Redis, so checking these doesn't cost a round trip
+        self.global_admins = RedisSet(rdb, 'global_admins', int)
+        self.waiting_setup = RedisSet(rdb, GUILDS_WAITING_SETUP_KEY, int)
+
+        # Kept across reloads, so other plugins' listeners stay subscribed
+        self.emitter = ctx.get('emitter') or Emitter()
+        self.command_matcher = CommandMatcher(self.bot)
 
         super(CorePlugin, self).load(ctx)
 
@@ -60,6 +105,9 @@ class CorePlugin(Plugin):
 
         self._wait_for_actions_greenlet = self.spawn(self.wait_for_actions)
 
+        # Command usage is written in batches
+        self.spawn(COMMAND_BATCH.run)
+
     def spawn_wait_for_actions(self, *args, **kwargs):
         self._wait_for_actions_greenlet = self.spawn(self.wait_for_actions)
         self._wait_for_actions_greenlet.link_exception(self.spawn_wait_for_actions)
@@ -122,6 +170,7 @@ class CorePlugin(Plugin):
                     self.update_rowboat_guild_access()
 
                     # Finally, emit the event
+                    self.update_dispatch(data['id'])
                     self.emitter.emit('GUILD_CONFIG_UPDATE', self.guilds[data['id']], config)
                 except:
                     self.log.exception('Failed to reload config for guild %s', self.guilds[data['id']].name)
@@ -133,6 +182,10 @@ class CorePlugin(Plugin):
     def unload(self, ctx):
         ctx['guilds'] = self.guilds
         ctx['startup'] = self.startup
+        ctx['emitter'] = self.emitter
+        self.global_admins.close()
+        self.waiting_setup.close()
+        COMMAND_BATCH.flush()
         super(CorePlugin, self).unload(ctx)
 
     def update_rowboat_guild_access(self):
@@ -199,7 +252,8 @@ class CorePlugin(Plugin):
         else:
             guild_id = None
 
-        if guild_id not in self.guilds:
+        dispatch = self.get_dispatch(guild_id)
+        if dispatch is None:
             if isinstance(event, CommandEvent):
                 if event.command.metadata.get('global_', False):
                     return event
@@ -209,22 +263,38 @@ class CorePlugin(Plugin):
 
             return
 
-        if hasattr(plugin, 'WHITELIST_FLAG'):
-            if int(plugin.WHITELIST_FLAG) not in self.guilds[guild_id].whitelist:
-                return
-
-        event.base_config = self.guilds[guild_id].get_config()
-        if not event.base_config:
+        plugin_config = dispatch.get_plugin_config(plugin)
+        if plugin_config is None:
+            self.dispatch_counts[(plugin.name, 'skipped')] += 1
             return
 
-        plugin_name = plugin.name.lower().replace('plugin', '')
-        if not getattr(event.base_config.plugins, plugin_name, None):
-            return
+        self.dispatch_counts[(plugin.name, 'dispatched')] += 1
 
-        self._attach_local_event_data(event, plugin_name, guild_id)
+        event.base_config = dispatch.config
+        self._attach_local_event_data(event, plugin_config, dispatch.guild)
 
         return event
 
+    def get_dispatch(self, guild_id):
+        # Guilds carried over a reload get their entry built on first use
+        dispatch = self.dispatch.get(guild_id)
+        if dispatch is None and guild_id in self.guilds:
+            dispatch = self.update_dispatch(guild_id)
+        return dispatch
+
+    def update_dispatch(self, guild_id):
+        if guild_id not in self.guilds:
+            self.dispatch.pop(guild_id, None)
+            return
+
+        dispatch = self.dispatch[guild_id] = GuildDispatch(self.guilds[guild_id])
+        return dispatch
+
+    def collect_dispatch_stats(self):
+        # Externally Used, by the StatsPlugin
+        counts, self.dispatch_counts = self.dispatch_counts, Counter()
+        return counts
+
     def get_config(self, guild_id, *args, **kwargs):
         # Externally Used
         return self.guilds[guild_id].get_config(*args, **kwargs)
@@ -236,15 +306,15 @@ class CorePlugin(Plugin):
     def crab(self):
         return 'crab'
 
-    def _attach_local_event_data(self, event, plugin_name, guild_id):
+    def _attach_local_event_data(self, event, plugin_config, guild):
         if not hasattr(event, 'config'):
             event.config = LocalProxy()
 
         if not hasattr(event, 'rowboat_guild'):
             event.rowboat_guild = LocalProxy()
 
-        event.config.set(getattr(event.base_config.plugins, plugin_name))
-        event.rowboat_guild.set(self.guilds[guild_id])
+        event.config.set(plugin_config)
+        event.rowboat_guild.set(guild)
 
     @Plugin.schedule(290, init=False)
     def update_guild_bans(self):
@@ -320,7 +390,7 @@ class CorePlugin(Plugin):
             guild = Guild.with_id(event.guild.id)
         except Guild.DoesNotExist:
             # If the guild is not awaiting setup, leave it now
-            if not rdb.sismember(GUILDS_WAITING_SETUP_KEY, str(event.guild.id)) and event.guild.id != ROWBOAT_GUILD_ID:
+            if event.guild.id not in self.waiting_setup and event.guild.id != ROWBOAT_GUILD_ID:
                 self.log.warning(
                     'Guild %s (%s) is awaiting setup.',
                     event.guild.id, event.guild.name
@@ -343,6 +413,8 @@ class CorePlugin(Plugin):
         #guild.request_guild_members()
 
         self.guilds[event.id] = guild
+        self.update_dispatch(event.id)
+        self.emitter.emit('GUILD_CONFIG_UPDATE', guild, config)
 
         if config.nickname:
             def set_nickname():
@@ -356,23 +428,19 @@ class CorePlugin(Plugin):
             self.spawn_later(5, set_nickname)
 
     def get_level(self, guild, user):
-        config = (guild.id in self.guilds and self.guilds.get(guild.id).get_config())
-
-        user_level = 0
-        if config:
-            member = guild.get_member(user)
-            if not member:
-                return user_level
+        dispatch = self.get_dispatch(guild.id)
+        if not dispatch or not dispatch.config:
+            return 0
 
-            for oid in member.roles:
-                if oid in config.levels and config.levels[oid] > user_level:
-                    user_level = config.levels[oid]
+        member = guild.get_member(user)
+        if not member:
+            return 0
 
-            # User ID overrides should override all others
-            if member.id in config.levels:
-                user_level = config.levels[member.id]
+        return dispatch.levels.get_level(member)
 
-        return user_level
+    def get_context(self, event):
+        # Externally Used
+        return EventContext.of(self, event)
 
     @Plugin.listen('MessageCreate')
     def on_message_create(self, event: MessageCreate):
@@ -383,10 +451,6 @@ class CorePlugin(Plugin):
         if event.message.author.bot:
             return
 
-        if event.guild_id:
-            if not event.message.channel.get_permissions(self.state.me).can(Permissions.SEND_MESSAGES, Permissions.VIEW_CHANNEL):
-                return
-
         # If this is message for a guild, grab the guild object
         if hasattr(event, 'guild') and event.guild:
             guild_id = event.guild.id
@@ -396,36 +460,26 @@ class CorePlugin(Plugin):
             guild_id = None
 
         guild = self.guilds.get(event.guild.id) if guild_id else None
-        config = guild and guild.get_config()
-
-        if config and config.commands:
-            # If the guild has configuration, use that (otherwise use defaults)
-            commands = list(self.bot.get_commands_for_message(
-                    config.commands.mention,
-                    {},
-                    config.commands.prefix if config.commands.prefix else config.commands.prefixes,
-                    event.message))
-        elif ENV != 'prod':
-            if event.message.content.startswith(ENV + '!'):
-                commands = list(self.bot.get_commands_for_message(False, {}, [ENV + '!'], event.message))
-            else:
-                return # fast fail, commands isn't set so we won't make it to the if not len commands check.
-        elif guild_id:
-            # Otherwise, default to requiring mentions
-            commands = list(self.bot.get_commands_for_message(True, {}, '', event.message))
-        else:
-            # DM's just use the commands (no prefix/mention)
-            commands = list(self.bot.get_commands_for_message(False, {}, '', event.message))
+
+        # Matching rejects anything without a prefix or mention up front, so
+        #  check for commands before computing our permissions
+        context = self.get_context(event)
+        config = context.config
+        commands = context.commands
 
         # If we didn't find any matching commands, return
         if not len(commands):
             return
 
-        event.user_level = self.get_level(event.guild, event.author) if event.guild else 0
+        if event.guild_id:
+            if not event.message.channel.get_permissions(self.state.me).can(Permissions.SEND_MESSAGES, Permissions.VIEW_CHANNEL):
+                return
+
+        event.user_level = context.level
 
         # Grab whether this user is a global admin
         # TODO: Get this from the database instead of Redis
-        global_admin = rdb.sismember('global_admins', event.author.id)
+        global_admin = event.author.id in self.global_admins
 
         # Iterate over commands and find a match
         for command, match in commands:
@@ -452,6 +506,7 @@ class CorePlugin(Plugin):
             if not global_admin and event.user_level < level:
                 continue
 
+            start = time.time()
             with timed('rowboat.command.duration', tags={'plugin': command.plugin.name, 'command': command.name}):
                 try:
                     command_event = CommandEvent(command, event, match)
@@ -460,7 +515,7 @@ class CorePlugin(Plugin):
                 except CommandResponse as e:
                     event.reply(e.response)
                 except:
-                    tracked = Command.track(event, command, exception=True)
+                    tracked = Command.track(event, command, exception=True, duration=time.time() - start)
                     self.log.exception('Command Error:')
 
                     with self.send_control_message() as embed:
@@ -476,7 +531,7 @@ class CorePlugin(Plugin):
 
                     return event.reply('<:{}> Something went wrong... try again later?'.format(RED_TICK_EMOJI))
 
-            Command.track(event, command)
+            Command.track(event, command, duration=time.time() - start)
 
             # Dispatch the command used modlog event
             if config:
@@ -484,7 +539,7 @@ class CorePlugin(Plugin):
                 if not modlog_config:
                     return
 
-                self._attach_local_event_data(event, 'modlog', event.guild.id)
+                self._attach_local_event_data(event, modlog_config, self.guilds[event.guild.id])
 
                 modlog = self.bot.plugins.get('ModLogPlugin')
                 if modlog:
@@ -497,7 +552,7 @@ class CorePlugin(Plugin):
         if not event.guild:
             raise CommandFail('This command can only be used in servers')
 
-        global_admin = rdb.sismember('global_admins', event.author.id)
+        global_admin = event.author.id in self.global_admins
 
         # Make sure this is the owner of the server
         if not global_admin:
@@ -510,8 +565,10 @@ class CorePlugin(Plugin):
             raise CommandFail('Bot must have the Administrator permission')
 
         guild = Guild.setup(event.guild)
-        rdb.srem(GUILDS_WAITING_SETUP_KEY, str(event.guild.id))
+        self.waiting_setup.remove(event.guild.id)
         self.guilds[event.guild.id] = guild
+        self.update_dispatch(event.guild.id)
+        self.emitter.emit('GUILD_CONFIG_UPDATE', guild, guild.get_config())
         raise CommandSuccess('Successfully loaded configuration')
 
     @Plugin.command('nuke', '<user:snowflake> <reason:str...>', level=-1)
@@ -716,12 +773,12 @@ class CorePlugin(Plugin):
 
     @Plugin.command('wh', '<guild:snowflake>', group='guilds', level=-1)
     def guild_whitelist(self, event, guild):
-        rdb.sadd(GUILDS_WAITING_SETUP_KEY, str(guild))
+        self.waiting_setup.add(guild)
         raise CommandSuccess('Ok, guild %s is now in the whitelist' % guild)
 
     @Plugin.command('unwh', '<guild:snowflake>', group='guilds', level=-1)
     def guild_unwhitelist(self, event, guild):
-        rdb.srem(GUILDS_WAITING_SETUP_KEY, str(guild))
+        self.waiting_setup.remove(guild)
         raise CommandSuccess('Ok, I\'ve made sure guild %s is no longer in the whitelist' % guild)
 
     @Plugin.command('leave', '<guild:snowflake>', group='guilds', level=-1)
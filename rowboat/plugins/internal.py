@@ -8,7 +8,7 @@ from peewee import fn
 
 from rowboat.models.channel import Channel
 from rowboat.models.event import Event
-from rowboat.models.message import Command, Message
+from rowboat.models.message import COMMAND_BATCH, COMMAND_LATENCY, Command, Message
 from rowboat.models.user import User
 from rowboat.plugins import CommandSuccess
 from rowboat.plugins import RowboatPlugin as Plugin
@@ -16,19 +16,31 @@ from rowboat.redis import rdb
 from rowboat.util.redis import RedisSet
 
 
+def format_latency(duration):
+    if duration is None:
+        return '-'
+    return '{}ms'.format(int(duration * 1000))
+
+
 class InternalPlugin(Plugin):
     global_plugin = True
 
     def load(self, ctx):
         super(InternalPlugin, self).load(ctx)
 
-        self.events = RedisSet(rdb, 'internal:tracked-events')
+        self.events = RedisSet(rdb, 'internal:tracked-events', str)
         self.session_id = None
         self.lock = Semaphore()
         self.cache = list()
 
+    def unload(self, ctx):
+        self.events.close()
+        super(InternalPlugin, self).unload(ctx)
+
     @Plugin.command('errors', group='commands', level=-1)
     def on_commands_errors(self, event):
+        COMMAND_BATCH.flush()
+
         q = Command.select().join(
             Message, on=(Command.message_id == Message.id)
         ).where(
@@ -45,6 +57,8 @@ class InternalPlugin(Plugin):
 
     @Plugin.command('info', '<mid:snowflake>', group='commands', level=-1)
     def on_commands_info(self, event, mid):
+        COMMAND_BATCH.flush()
+
         cmd = Command.select(Command, Message, Channel).join(
             Message, on=(Command.message_id == Message.id).alias('message')
         ).join(
@@ -72,6 +86,8 @@ class InternalPlugin(Plugin):
 
     @Plugin.command('usage', group='commands', level=-1)
     def on_commands_usage(self, event):
+        COMMAND_BATCH.flush()
+
         q = Command.select(
             fn.COUNT('*'),
             Command.plugin,
@@ -81,15 +97,18 @@ class InternalPlugin(Plugin):
         ).order_by(fn.COUNT('*').desc()).limit(25)
 
         tbl = MessageTable()
-        tbl.set_header('Plugin', 'Command', 'Usage')
+        tbl.set_header('Plugin', 'Command', 'Usage', 'p50', 'p99')
 
         for count, plugin, command in q.tuples():
-            tbl.add(plugin, command, count)
+            latency = COMMAND_LATENCY.percentiles((plugin, command)) or {}
+            tbl.add(plugin, command, count, format_latency(latency.get(50)), format_latency(latency.get(99)))
 
         event.msg.reply(tbl.compile())
 
     @Plugin.command('stats', '<name:str>', group='commands', level=-1)
     def on_commands_stats(self, event, name):
+        COMMAND_BATCH.flush()
+
         if '.' in name:
             plugin, command = name.split('.', 1)
             q = (
@@ -111,11 +130,23 @@ class InternalPlugin(Plugin):
             else:
                 error = count
 
-        raise CommandSuccess('Command `{}` was used a total of {} times, {} of those had errors'.format(
+        response = 'Command `{}` was used a total of {} times, {} of those had errors'.format(
             name,
             success + error,
             error
-        ))
+        )
+
+        # Latency is only known for commands run since this process started
+        for key in sorted(COMMAND_LATENCY.keys()):
+            if key[1] != name and '.'.join(key) != name:
+                continue
+
+            latency = COMMAND_LATENCY.percentiles(key)
+            if latency:
+                response += '\n`{}.{}` p50 {}, p90 {}, p99 {}'.format(
+                    key[0], key[1], *(format_latency(latency[point]) for point in (50, 90, 99)))
+
+        raise CommandSuccess(response)
 
     @Plugin.command('throw', level=-1)
     def on_throw(self, event):
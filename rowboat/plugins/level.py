@@ -71,16 +71,8 @@ class LevelPlugin(Plugin):
         if event.author.bot:
             return
 
-        config = self.call('CorePlugin.get_config', event.guild.id)
-
-        if config and config.commands:
-            commands = list(self.bot.get_commands_for_message(
-                config.commands.mention,
-                {},
-                config.commands.prefix if config.commands.prefix else config.commands.prefixes,
-                event.message))
-        
-        if commands:
+        # Matched once per message and shared with the CorePlugin
+        if self.call('CorePlugin.get_context', event).commands:
             return  # No XP for commands
 
         try:
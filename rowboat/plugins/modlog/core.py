@@ -1,8 +1,10 @@
+import heapq
+import itertools
 import operator
 import re
 import string
 import time
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 from datetime import datetime
 from functools import reduce
 
@@ -23,13 +25,16 @@ from rowboat.types.plugin import PluginConfig
 from rowboat.util import MetaException, ordered_load
 from rowboat.util.time import timestamp_now
 
-from .pump import ModLogPump
+from .pump import ModLogScheduler
 
 # Dynamically updated by the plugin
 Actions = Enum()
 
 URL_REGEX = re.compile(r'(https?://[^\s]+)')
 
+# How long a debounce suppresses its events for
+DEBOUNCE_TTL = 60
+
 
 def filter_urls(content):
     return URL_REGEX.sub(r'<\1>', content)
@@ -73,6 +78,9 @@ class ModLogConfig(PluginConfig):
     channels = DictField(ChannelField, ChannelConfig)
     new_member_threshold = Field(int, default=(15 * 60))
 
+    # Lines held per channel while it's backed up, older ones are collapsed
+    buffer_size = Field(int, default=1000)
+
     _custom = DictField(dict, private=True)
     _channels = DictField(ChannelConfig, private=True)
 
@@ -96,49 +104,87 @@ class Debounce(object):
         self.events = events
         self.timestamp = time.time()
 
+    @property
+    def expires_at(self):
+        return self.timestamp + DEBOUNCE_TTL
+
     def is_expired(self):
-        return time.time() - self.timestamp > 60
+        return time.time() > self.expires_at
 
     def remove(self, event=None):
         self.plugin.debounces.remove(self, event)
 
 
 class DebouncesCollection(object):
+    """
+    Debounces indexed by guild, event name and selector. A debounce matches a
+    lookup when every key in its selector has the looked up value, so a lookup
+    only has to probe each subset of the (few) keys it was given. Debounces
+    expire off a heap ordered by expiry time.
+    """
+
     def __init__(self):
-        self._data = defaultdict(lambda: defaultdict(list))
+        # (guild_id, event name, selector items) -> {id(debounce): debounce}
+        self._data = defaultdict(OrderedDict)
+        self._expiry = []
+        self._counter = 0
 
     def __iter__(self):
-        for top in list(self._data.values()):
-            for bot in list(top.values()):
-                for obj in bot:
-                    yield obj
+        for bucket in list(self._data.values()):
+            for obj in list(bucket.values()):
+                yield obj
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self._data.values())
+
+    @staticmethod
+    def _key(guild_id, event_name, selector):
+        return (guild_id, event_name, frozenset(selector.items()))
 
     def add(self, obj):
         for event_name in obj.events:
-            self._data[obj.guild_id][event_name].append(obj)
+            self._data[self._key(obj.guild_id, event_name, obj.selector)][id(obj)] = obj
+
+        # The counter keeps debounces created at the same time from being compared
+        self._counter += 1
+        heapq.heappush(self._expiry, (obj.expires_at, self._counter, obj))
 
     def remove(self, obj, event=None):
-        for event_name in ([event] if event else obj.events):
+        for event_name in ([event] if event else list(obj.events)):
             if event_name in obj.events:
                 obj.events.remove(event_name)
 
-            if obj in self._data[obj.guild_id][event_name]:
-                self._data[obj.guild_id][event_name].remove(obj)
+            key = self._key(obj.guild_id, event_name, obj.selector)
+            bucket = self._data.get(key)
+            if bucket is not None:
+                bucket.pop(id(obj), None)
+                if not bucket:
+                    del self._data[key]
+
+    def expire(self):
+        now = time.time()
+        while self._expiry and self._expiry[0][0] < now:
+            _, _, obj = heapq.heappop(self._expiry)
+            obj.remove()
 
     def find(self, event, delete=True, **kwargs):
-        guild_id = event.guild_id if hasattr(event, 'guild_id') else event.guild.id
-        for obj in self._data[guild_id][event.__class__.__name__]:
-            if obj.is_expired():
-                obj.remove()
-                continue
+        self.expire()
 
-            for k, v in list(kwargs.items()):
-                if obj.selector.get(k) != v:
+        guild_id = event.guild_id if hasattr(event, 'guild_id') else event.guild.id
+        event_name = event.__class__.__name__
+
+        # Prefer the most specific debounce
+        items = list(kwargs.items())
+        for size in range(len(items), -1, -1):
+            for selector in itertools.combinations(items, size):
+                bucket = self._data.get((guild_id, event_name, frozenset(selector)))
+                if not bucket:
                     continue
 
-            if delete:
-                obj.remove(event=event.__class__.__name__)
-            return obj
+                obj = next(iter(bucket.values()))
+                if delete:
+                    obj.remove(event=event_name)
+                return obj
 
 
 @Plugin.with_config(ModLogConfig)
@@ -159,11 +205,23 @@ class ModLogPlugin(Plugin):
         # Tracks modlogs that are silenced
         self.hushed = {}
 
-        # Tracks pumps for all modlogs
-        self.pumps = {}
+        # Delivers output for all modlogs
+        self.scheduler = ModLogScheduler()
+
+        # Guilds subscribed to username changes, and which of them each user is in
+        self.username_guilds = set()
+        self.username_members = defaultdict(set)
 
         super(ModLogPlugin, self).load(ctx)
 
+        self._config_listener = None
+        core = self.bot.plugins.get('CorePlugin')
+        if core:
+            self._config_listener = core.emitter.on('GUILD_CONFIG_UPDATE', self.on_guild_config_update)
+
+            for guild_id, guild in list(core.guilds.items()):
+                self.update_username_index(guild_id, guild.get_config())
+
     def create_debounce(self, event, events, **kwargs):
         if isinstance(event, int):
             guild_id = event
@@ -176,8 +234,45 @@ class ModLogPlugin(Plugin):
     def unload(self, ctx):
         ctx['action_simple'] = self.action_simple
         ctx['debounces'] = self.debounces
+        self.scheduler.stop()
+
+        if self._config_listener:
+            self._config_listener.remove()
+
         super(ModLogPlugin, self).unload(ctx)
 
+    def on_guild_config_update(self, guild, config):
+        self.update_username_index(guild.guild_id, config)
+
+    def update_username_index(self, guild_id, config):
+        guild = self.state.guilds.get(guild_id)
+        subscribed = bool(
+            guild and config and config.plugins and config.plugins.modlog and
+            Actions.CHANGE_USERNAME in config.plugins.modlog.subscribed
+        )
+
+        if subscribed:
+            self.username_guilds.add(guild_id)
+            for user_id in guild.members.keys():
+                self.username_members[user_id].add(guild_id)
+        elif guild_id in self.username_guilds:
+            self.username_guilds.discard(guild_id)
+            for user_id, guild_ids in list(self.username_members.items()):
+                guild_ids.discard(guild_id)
+                if not guild_ids:
+                    del self.username_members[user_id]
+
+    def _index_member(self, guild_id, user_id, present):
+        if guild_id not in self.username_guilds:
+            return
+
+        if present:
+            self.username_members[user_id].add(guild_id)
+        elif user_id in self.username_members:
+            self.username_members[user_id].discard(guild_id)
+            if not self.username_members[user_id]:
+                del self.username_members[user_id]
+
     def resolve_channels(self, guild, config):
         self.log.info('Resolving channels for guild %s (%s)', guild.id, guild.name)
 
@@ -288,11 +383,7 @@ class ModLogPlugin(Plugin):
 
             msg = generate_simple(chan_config)
 
-            if channel_id not in self.pumps:
-                self.pumps[channel_id] = ModLogPump(
-                    self.state.channels.get(channel_id),
-                )
-            self.pumps[channel_id].send(msg)
+            self.scheduler.send(self.state.channels.get(channel_id), msg, max_buffer_size=config.buffer_size)
 
     @Plugin.command('hush', group='modlog', level=CommandLevels.ADMIN)
     def command_hush(self, event):
@@ -312,9 +403,7 @@ class ModLogPlugin(Plugin):
 
     @Plugin.schedule(120)
     def cleanup_debounce(self):
-        for obj in self.debounces:
-            if obj.is_expired():
-                obj.remove()
+        self.debounces.expire()
 
     @Plugin.listen('ChannelCreate')
     def on_channel_create(self, event):
@@ -340,8 +429,19 @@ class ModLogPlugin(Plugin):
 
         self.log_action(Actions.GUILD_BAN_REMOVE, event)
 
+    @Plugin.listen('GuildDelete', metadata={'global_': True})
+    def on_guild_delete(self, event):
+        self.update_username_index(event.id, None)
+
+    @Plugin.listen('GuildMembersChunk')
+    def on_guild_members_chunk(self, event):
+        for member in event.members:
+            self._index_member(event.guild_id, member.id, True)
+
     @Plugin.listen('GuildMemberAdd')
     def on_guild_member_add(self, event):
+        self._index_member(event.guild_id, event.user.id, True)
+
         created = humanize.naturaltime(timestamp_now() - to_unix(event.user.id))
         new = (
             event.config.new_member_threshold and
@@ -352,6 +452,8 @@ class ModLogPlugin(Plugin):
 
     @Plugin.listen('GuildMemberRemove')
     def on_guild_member_remove(self, event):
+        self._index_member(event.guild_id, event.user.id, False)
+
         debounce = self.debounces.find(event, user_id=event.user.id)
 
         if debounce:
@@ -436,11 +538,16 @@ class ModLogPlugin(Plugin):
         if not plugin or not event.user:
             return
 
+        guild_ids = self.username_members.get(event.user.id)
+        if not guild_ids:
+            return
+
         subscribed_guilds = defaultdict(list)
 
-        for guild_id, config in list(plugin.guilds.items()):
+        for guild_id in list(guild_ids):
             guild = self.state.guilds.get(guild_id)
-            if not guild:
+            config = plugin.guilds.get(guild_id)
+            if not guild or not config:
                 continue
 
             if event.user.id not in guild.members:
@@ -484,11 +591,8 @@ class ModLogPlugin(Plugin):
         if event.channel_id in event.config.ignored_channels:
             return
 
-        from rowboat.models.message import Message
-
-        try:
-            msg = Message.get(Message.id == event.id)
-        except Message.DoesNotExist:
+        msg = self.get_safe_plugin('SQLPlugin').get_message(event.id)
+        if not msg:
             return
 
         if not event.channel or not event.author:
@@ -506,11 +610,8 @@ class ModLogPlugin(Plugin):
         if event.guild.id in self.hushed:
             return
 
-        from rowboat.models.message import Message
-
-        try:
-            msg = Message.get(Message.id == event.id)
-        except Message.DoesNotExist:
+        msg = self.get_safe_plugin('SQLPlugin').get_message(event.id)
+        if not msg:
             return
 
         channel = self.state.channels.get(msg.channel_id)
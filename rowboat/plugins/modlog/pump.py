@@ -1,85 +1,176 @@
+import heapq
 import time
+from collections import deque
 
 import gevent
+from datadog import statsd
 from disco.api.http import APIException
 from disco.util.logging import LoggingClass
+from gevent.event import Event
+from gevent.pool import Pool
 
+from rowboat.util.stats import increment, to_tags
 
-class ModLogPump(LoggingClass):
-    def __init__(self, channel, sleep_duration=5):
+
+# Discord's limit on message content length
+MAX_MESSAGE_LENGTH = 2000
+
+
+class ModLogPump(object):
+    """
+    Buffers modlog lines for a channel so they can be sent in as few messages
+    as possible. At most `max_buffer_size` lines are held, once that's exceeded
+    the oldest lines are collapsed into a summary of how many were dropped.
+    """
+
+    def __init__(self, channel, max_buffer_size=1000):
         self.channel = channel
+        self.max_buffer_size = max_buffer_size
+        self._buffer = deque()
+        self._dropped = 0
+
+        # Whether the channel is waiting on, or being serviced by, the scheduler
+        self.scheduled = False
+        self.quiescent_period = None
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def _get_next_message(self):
+        lines = []
+        length = -1
+        oldest = None
+
+        if self._dropped:
+            lines.append(':warning: {} modlog entries were dropped while this channel was backed up'.format(
+                self._dropped))
+            length += len(lines[0]) + 1
+            self._dropped = 0
+
+        # Only take a line once we know it fits, each line after the first
+        #  costs one extra character for its newline
+        while self._buffer and length + len(self._buffer[0][1]) + 1 <= MAX_MESSAGE_LENGTH:
+            queued_at, line = self._buffer.popleft()
+            oldest = oldest or queued_at
+            lines.append(line)
+            length += len(line) + 1
+
+        return '\n'.join(lines), oldest
+
+    def send(self, payload):
+        self._buffer.append((time.time(), payload[:MAX_MESSAGE_LENGTH]))
+
+        if len(self._buffer) > self.max_buffer_size:
+            self._buffer.popleft()
+            self._dropped += 1
+
+
+class ModLogScheduler(LoggingClass):
+    """
+    Delivers modlog output for every channel from a single scheduling loop and
+    a shared pool of workers. Each channel is serviced by at most one worker at
+    a time, and channels which are rate limited (or can't be sent to) are put
+    into a quiescent period where they are only serviced every
+    `sleep_duration` seconds, batching up their output in the meantime. A
+    channel's pump only exists while it has output waiting or is quiescent.
+    """
+
+    def __init__(self, workers=8, sleep_duration=5):
         self.sleep_duration = sleep_duration
-        self._buffer = list()
-        self._have = gevent.event.Event()
-        self._quiescent_period = None
-        self._lock = gevent.lock.Semaphore()
+        self.pumps = {}
 
-        self._greenlet = gevent.spawn(self._emitter_loop)
+        self._ready = deque()
+        self._delayed = []
+        self._have = Event()
+        self._pool = Pool(workers)
 
-    def _start_emitter(self, greenlet=None):
-        self.log.warning('Restarting emitter for ModLogPump %s' % self.channel)
-        self._greenlet = gevent.spawn(self._emitter_loop)
-        self._greenlet.link_exception(self._start_emitter)
+        self._greenlet = None
+        self._start_scheduler()
 
-    def __del__(self):
-        if self._greenlet:
-            self._greenlet.kill()
+    def _start_scheduler(self, greenlet=None):
+        if greenlet:
+            self.log.warning('Restarting ModLogScheduler')
 
-    def _emitter_loop(self):
-        while True:
-            self._have.wait()
-
-            backoff = False
-
-            with self.channel.client.api.capture() as responses:
-                try:
-                    self._emit()
-                except APIException as e:
-                    # Message send is disabled
-                    if e.code == 40004:
-                        backoff = True
-                except Exception:
-                    self.log.exception('Exception when executing ModLogPump._emit: ')
-
-            if responses.rate_limited:
-                backoff = True
-
-            # If we need to backoff, set a quiescent period that will batch
-            #  requests for the next 60 seconds.
-            if backoff:
-                self._quiescent_period = time.time() + 60
-
-            if self._quiescent_period:
-                if self._quiescent_period < time.time():
-                    self._quiescent_period = None
-                else:
-                    gevent.sleep(self.sleep_duration)
-
-            if not self._buffer:
-                self._have.clear()
+        self._greenlet = gevent.spawn(self._scheduler_loop)
+        self._greenlet.link_exception(self._start_scheduler)
 
-    def _emit(self):
-        with self._lock:
-            msg = self._get_next_message()
-            if not msg:
-                return
+    def stop(self):
+        self._greenlet.unlink(self._start_scheduler)
+        self._greenlet.kill()
+        self._pool.kill()
 
-            self.channel.send_message(msg)
+    def send(self, channel, payload, max_buffer_size=1000):
+        pump = self.pumps.get(channel.id)
+        if not pump:
+            pump = self.pumps[channel.id] = ModLogPump(channel, max_buffer_size)
 
-    def _get_next_message(self):
-        data = ''
+        pump.max_buffer_size = max_buffer_size
+        pump.send(payload)
 
-        while self._buffer:
-            payload = self._buffer.pop(0)
-            if len(data) + (len(payload) + 1) > 2000:
-                break
+        if not pump.scheduled:
+            pump.scheduled = True
+            self._schedule(pump)
 
-            data += '\n'
-            data += payload
+    def _schedule(self, pump):
+        if pump.quiescent_period and pump.quiescent_period > time.time():
+            heapq.heappush(self._delayed, (time.time() + self.sleep_duration, pump.channel.id))
+        else:
+            pump.quiescent_period = None
+            self._ready.append(pump.channel.id)
 
-        return data
+        self._have.set()
 
-    def send(self, payload):
-        with self._lock:
-            self._buffer.append(payload)
-            self._have.set()
+    def _scheduler_loop(self):
+        while True:
+            now = time.time()
+            while self._delayed and self._delayed[0][0] <= now:
+                self._ready.append(heapq.heappop(self._delayed)[1])
+
+            if not self._ready:
+                self._have.clear()
+                self._have.wait(timeout=(self._delayed[0][0] - now) if self._delayed else None)
+                continue
+
+            # Blocks while every worker is busy
+            self._pool.spawn(self._service, self.pumps[self._ready.popleft()])
+
+    def _service(self, pump):
+        backoff = False
+        tags = to_tags({'channel_id': pump.channel.id})
+
+        with pump.channel.client.api.capture() as responses:
+            try:
+                msg, oldest = pump._get_next_message()
+                if msg:
+                    pump.channel.send_message(msg)
+
+                if oldest:
+                    statsd.timing('rowboat.modlog.delivery_latency', (time.time() - oldest) * 1000, tags=tags)
+            except APIException as e:
+                # Message send is disabled
+                if e.code == 40004:
+                    backoff = True
+            except Exception:
+                self.log.exception('Exception when servicing ModLogPump for %s: ', pump.channel.id)
+
+        if responses.rate_limited:
+            increment('rowboat.modlog.rate_limited', tags={'channel_id': pump.channel.id})
+            backoff = True
+
+        # If we need to backoff, set a quiescent period that will batch
+        #  requests for the next 60 seconds.
+        if backoff:
+            pump.quiescent_period = time.time() + 60
+
+        statsd.gauge('rowboat.modlog.queue_depth', len(pump), tags=tags)
+
+        if len(pump):
+            self._schedule(pump)
+        else:
+            pump.scheduled = False
+
+            # Idle pumps are dropped rather than kept for every channel ever
+            #  logged to, unless they still need to remember their backoff
+            if not pump.quiescent_period or pump.quiescent_period <= time.time():
+                if self.pumps.get(pump.channel.id) is pump:
+                    del self.pumps[pump.channel.id]
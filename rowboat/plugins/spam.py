@@ -1,27 +1,56 @@
-import operator
 import re
 import time
-from collections import defaultdict
+from collections import Counter, OrderedDict, defaultdict, deque
 from datetime import datetime, timedelta, timezone
-from functools import reduce
 
 from disco.util.enum import Enum
 from disco.util.emitter import Priority
-from gevent.lock import Semaphore
 
 from rowboat.models.message import EMOJI_RE, Message
 from rowboat.models.user import Infraction
 from rowboat.plugins import RowboatPlugin as Plugin
-from rowboat.plugins.censor import URL_RE
 from rowboat.plugins.modlog import Actions
 from rowboat.redis import rdb
 from rowboat.types import DictField, Field, SlottedModel
 from rowboat.types.plugin import PluginConfig
-from rowboat.util.leakybucket import LeakyBucket
+from rowboat.util.gevent import KeyedSemaphore
+from rowboat.util.leakybucket import LeakyBucket, LeakyBucketBatch
+from rowboat.util.scan import MessageScan
 from rowboat.util.stats import timed
 
 UPPER_RE = re.compile('[A-Z]')
 
+# Bucketed checks, in the order they are evaluated, and their violation text
+CHECKS = OrderedDict([
+    ('max_messages', 'Too Many Messages'),
+    ('max_mentions', 'Too Many Mentions'),
+    ('max_links', 'Too Many Links'),
+    ('max_upper_case', 'Too Many Capitals'),
+    # TODO: Unicode Emoji, Stickers
+    ('max_emojis', 'Too Many Emojis'),
+    ('max_newlines', 'Too Many Newlines'),
+    ('max_attachments', 'Too Many Attachments'),
+])
+
+FEATURES = {
+    'max_messages': lambda e: 1,
+    'max_mentions': lambda e: len(e.message.mentions),
+    'max_links': lambda e: len(MessageScan.of(e).links),
+    'max_upper_case': lambda e: len(UPPER_RE.findall(e.message.content)),
+    'max_emojis': lambda e: len(EMOJI_RE.findall(e.message.content)),
+    'max_newlines': lambda e: e.message.content.count('\n') + e.message.content.count('\r'),
+    'max_attachments': lambda e: len(e.message.attachments),
+}
+
+
+def extract_features(event, names):
+    """
+    Computes each of the given message metrics once, so they can be shared by
+    every rule that applies to the message.
+    """
+    return {name: FEATURES[name](event) for name in names}
+
+
 PunishmentType = Enum( # Why isn't this InfractionTypes?
     'NONE',
     'MUTE',
@@ -31,6 +60,13 @@ PunishmentType = Enum( # Why isn't this InfractionTypes?
     'TEMPMUTE'
 )
 
+# What spam checks are linearized by, checks for different keys run concurrently
+LinearizeType = Enum(
+    'AUTHOR',
+    'CHANNEL',
+    'GUILD'
+)
+
 
 class CheckConfig(SlottedModel):
     count = Field(int)
@@ -85,27 +121,155 @@ class SubConfig(SlottedModel):
 
         return obj, bucket
 
+    def compile_checks(self, guild_id):
+        checks = []
+        for name, label in CHECKS.items():
+            check, bucket = self.get_bucket(name, guild_id)
+            if bucket:
+                checks.append((name, label, check, bucket))
+        return checks
 
-class SpamConfig(PluginConfig):
-    roles = DictField(str, SubConfig)
-    levels = DictField(int, SubConfig)
+    @property
+    def checks_duplicates(self):
+        return bool(self.max_duplicates and self.max_duplicates.interval and self.max_duplicates.count)
+
+    @property
+    def duplicates_global(self):
+        return bool((self.max_duplicates.meta or {}).get('global'))
+
+    def get_duplicates_key(self, guild_id, member_id):
+        # If we're not checking globally, include the member id
+        return guild_id, None if self.duplicates_global else member_id, self.max_duplicates.interval
+
+
+class SpamRulePlan(object):
+    """
+    A guild's spam rules compiled down to lookup tables and the bucketed checks
+    each rule needs.
+    """
+
+    def __init__(self, config, guild_id):
+        self.roles = dict(config.roles or {})
+        self.levels = list((config.levels or {}).items())
+
+        self.checks = {}
+        self.global_duplicates = []
+        for rule in list(self.roles.values()) + [rule for _, rule in self.levels]:
+            if id(rule) not in self.checks:
+                self.checks[id(rule)] = rule.compile_checks(guild_id)
+
+                # These count every message in the guild, whoever it's from
+                if rule.checks_duplicates and rule.duplicates_global:
+                    self.global_duplicates.append(rule)
+
+    def compute_features(self, rules):
+        return {name for rule in rules for name, _, _, _ in self.checks[id(rule)]}
 
     def compute_relevant_rules(self, member, level):
+        rules = OrderedDict()
+
+        def add(rule):
+            rules.setdefault(id(rule), rule)
+
         if self.roles:
             if '*' in self.roles:
-                yield self.roles['*']
+                add(self.roles['*'])
 
             for rid in member.roles:
-                if rid in self.roles:
-                    yield self.roles[rid]
+                if str(rid) in self.roles:
+                    add(self.roles[str(rid)])
                 rname = member.guild.roles.get(rid)
                 if rname and rname.name in self.roles:
-                    yield self.roles[rname.name]
+                    add(self.roles[rname.name])
 
-        if self.levels:
-            for lvl in list(self.levels.keys()):
-                if level <= lvl:
-                    yield self.levels[lvl]
+        for lvl, rule in self.levels:
+            if level <= lvl:
+                add(rule)
+
+        return list(rules.values())
+
+
+class SpamConfig(PluginConfig):
+    roles = DictField(str, SubConfig)
+    levels = DictField(int, SubConfig)
+
+    linearize = Field(LinearizeType, default=LinearizeType.AUTHOR)
+
+    _cached_plan = Field(str, private=True)
+
+    def get_plan(self, guild_id):
+        plan = getattr(self, '_cached_plan', None)
+        if not plan:
+            plan = SpamRulePlan(self, guild_id)
+            setattr(self, '_cached_plan', plan)
+        return plan
+
+    def compute_relevant_rules(self, member, level):
+        return self.get_plan(member.guild_id).compute_relevant_rules(member, level)
+
+    def get_lock_key(self, event):
+        if self.linearize == LinearizeType.GUILD:
+            return (event.guild.id, )
+        elif self.linearize == LinearizeType.CHANNEL:
+            return event.guild.id, event.channel.id
+        return event.guild.id, event.author.id
+
+
+class DuplicateTracker(object):
+    """
+    Rolling windows of recent message content hashes, keyed by guild and
+    (unless checking globally) author, so duplicates can be counted without
+    going back to the messages table. Each window keeps at most the last
+    `max_entries` messages sent within its interval.
+    """
+
+    def __init__(self, max_entries=50):
+        self.max_entries = max_entries
+        self._windows = {}
+
+    def __len__(self):
+        return len(self._windows)
+
+    def add(self, key, interval, content):
+        """
+        Records the content in the window for `key` and returns how many times
+        it now appears there.
+        """
+        now = time.time()
+
+        window = self._windows.get(key)
+        if not window:
+            window = self._windows[key] = (deque(), Counter(), interval)
+
+        entries, counts, _ = window
+        self._expire(entries, counts, now - interval)
+
+        digest = hash(content)
+        entries.append((now, digest))
+        counts[digest] += 1
+
+        if len(entries) > self.max_entries:
+            self._pop(entries, counts)
+
+        return counts[digest]
+
+    def prune(self):
+        now = time.time()
+        for key, (entries, counts, interval) in list(self._windows.items()):
+            self._expire(entries, counts, now - interval)
+            if not entries:
+                del self._windows[key]
+
+    def _expire(self, entries, counts, cutoff):
+        while entries and entries[0][0] < cutoff:
+            self._pop(entries, counts)
+
+    @staticmethod
+    def _pop(entries, counts):
+        _, digest = entries.popleft()
+        counts[digest] -= 1
+        if not counts[digest]:
+            del counts[digest]
 
 
 class Violation(Exception):
@@ -123,7 +287,13 @@ class Violation(Exception):
 class SpamPlugin(Plugin):
     def load(self, ctx):
         super(SpamPlugin, self).load(ctx)
-        self.guild_locks = {}
+        self.locks = KeyedSemaphore()
+        self.buckets = LeakyBucketBatch(rdb)
+        self.duplicates = DuplicateTracker()
+
+    @Plugin.schedule(60, init=False)
+    def prune_duplicates(self):
+        self.duplicates.prune()
 
     def violate(self, violation):
         key = 'lv:{e.member.guild_id}:{e.member.id}'.format(e=violation.event)
@@ -177,6 +347,8 @@ class SpamPlugin(Plugin):
 
             # Clean messages if requested
             if punishment != PunishmentType.NONE and violation.rule.clean:
+                self.get_safe_plugin('SQLPlugin').flush_messages()
+
                 msgs = Message.select(
                     Message.id,
                     Message.channel_id
@@ -197,65 +369,50 @@ class SpamPlugin(Plugin):
 
                     channel.delete_messages(messages)
 
-    def check_duplicate_messages(self, event, member, rule):
-        q = [
-            (Message.guild_id == event.guild.id),
-            (Message.timestamp > (datetime.now(timezone.utc) - timedelta(seconds=rule.max_duplicates.interval)))
-        ]
-
-        # If we're not checking globally, include the member id
-        if not rule.max_duplicates.meta or not rule.max_duplicates.meta.get('global'):
-            q.append((Message.author_id == member.id))
-
-        # Grab the previous messages the user sent in this server
-        msgs = list(Message.select(
-            Message.id,
-            Message.content,
-        ).where(reduce(operator.and_, q)).order_by(
-            Message.timestamp.desc()
-        ).limit(50).tuples())
-
-        # Group the messages by their content
-        dupes = defaultdict(int)
-        for mid, content in msgs:
-            if content:
-                dupes[content] += 1
-
-        # If any of them are above the max dupes count, trigger a violation
-        dupes = [v for k, v in list(dupes.items()) if v > rule.max_duplicates.count]
-        if dupes:
-            raise Violation(
-                rule,
-                rule.max_duplicates,
-                event,
-                member,
-                'MAX_DUPLICATES',
-                'Too Many Duplicated Messages ({} / {})'.format(
-                    sum(dupes),
-                    len(dupes)))
-
-    def check_message_simple(self, event, member, rule):
-        def check_bucket(name, base_text, func):
-            check, bucket = rule.get_bucket(name, event.guild.id)
-            if not bucket:
-                return
-
-            if not bucket.check(event.author.id, func(event) if callable(func) else func):
+    def record_duplicates(self, event, member, plan, rules):
+        """
+        Records the message once in every duplicate window it belongs to, and
+        returns how many times it now appears in each. Global windows see every
+        message, including those from members none of their rules apply to.
+        """
+        if not event.message.content:
+            return {}
+
+        counts = {}
+        for rule in plan.global_duplicates + [rule for rule in rules if rule.checks_duplicates]:
+            key = rule.get_duplicates_key(event.guild.id, member.id)
+            if key not in counts:
+                counts[key] = self.duplicates.add(key, rule.max_duplicates.interval, event.message.content)
+        return counts
+
+    def check_duplicate_messages(self, event, member, rules, counts):
+        for rule in rules:
+            key = rule.get_duplicates_key(event.guild.id, member.id)
+            if key in counts and counts[key] > rule.max_duplicates.count:
+                raise Violation(
+                    rule,
+                    rule.max_duplicates,
+                    event,
+                    member,
+                    'MAX_DUPLICATES',
+                    'Too Many Duplicated Messages ({} / {}s)'.format(counts[key], rule.max_duplicates.interval))
+
+    def check_message_simple(self, event, member, plan, rules, features, duplicates):
+        checks = [(rule, check) for rule in rules for check in plan.checks[id(rule)]]
+
+        # All buckets for all rules are evaluated in one round trip, stopping
+        #  at the first one that overflows.
+        states = self.buckets.check([
+            (bucket, event.author.id, features[name]) for _, (name, _, _, bucket) in checks
+        ])
+
+        for (rule, (name, label, check, bucket)), state in zip(checks, states):
+            if self.buckets.is_full(bucket, state):
                 raise Violation(rule, check, event, member,
                                 name.upper(),
-                    base_text + ' ({} / {}s)'.format(bucket.count(event.author.id), bucket.size(event.author.id)))
+                    label + ' ({} / {}s)'.format(state.count, state.size))
 
-        check_bucket('max_messages', 'Too Many Messages', 1)
-        check_bucket('max_mentions', 'Too Many Mentions', lambda e: len(e.mentions))
-        check_bucket('max_links', 'Too Many Links', lambda e: len(URL_RE.findall(e.message.content)))
-        check_bucket('max_upper_case', 'Too Many Capitals', lambda e: len(UPPER_RE.findall(e.message.content)))
-        # TODO: Unicode Emoji, Stickers
-        check_bucket('max_emojis', 'Too Many Emojis', lambda e: len(EMOJI_RE.findall(e.message.content)))
-        check_bucket('max_newlines', 'Too Many Newlines', lambda e: e.message.content.count('\n') + e.message.content.count('\r'))
-        check_bucket('max_attachments', 'Too Many Attachments', lambda e: len(e.message.attachments))
-
-        if rule.max_duplicates and rule.max_duplicates.interval and rule.max_duplicates.count:
-            self.check_duplicate_messages(event, member, rule)
+        self.check_duplicate_messages(event, member, [rule for rule in rules if rule.checks_duplicates], duplicates)
 
     @Plugin.listen('MessageCreate', priority=Priority.BEFORE)
     def on_message_create(self, event):
@@ -265,28 +422,32 @@ class SpamPlugin(Plugin):
         if event.message.author.bot:
             return
 
-        # Lineralize events by guild ID to prevent spamming events
-        if event.guild.id not in self.guild_locks:
-            self.guild_locks[event.guild.id] = Semaphore()
-        self.guild_locks[event.guild.id].acquire()
-
+        # Linearize events (by author unless configured otherwise) to prevent
+        #  racing a user's own messages through the buckets
         tags = {'guild_id': event.guild.id, 'channel_id': event.channel.id}
-        with timed('rowboat.plugin.spam.duration', tags=tags):
+        with self.locks.acquire(event.config.get_lock_key(event)), timed('rowboat.plugin.spam.duration', tags=tags):
             try:
-                member = event.guild.get_member(event.author)
+                context = self.bot.plugins.get('CorePlugin').get_context(event)
+
+                member = context.member
                 if not member:
                     self.log.warning(
                         'Failed to find member for guild id %s and author id %s', event.guild.id, event.author.id)
                     return
 
-                level = int(self.bot.plugins.get('CorePlugin').get_level(event.guild, event.author))
+                level = int(context.level)
+
+                plan = event.config.get_plan(event.guild.id)
+                rules = plan.compute_relevant_rules(member, level)
+
+                # Recorded before any rule is checked, so a message which breaks
+                #  one still counts towards later duplicates
+                duplicates = self.record_duplicates(event, member, plan, rules)
+                if not rules:
+                    return
 
-                # TODO: We should linearize the work required for all rules in one go,
-                #  we repeat all the work in each rule which sucks.
+                features = extract_features(event, plan.compute_features(rules))
 
-                for rule in event.config.compute_relevant_rules(member, level):
-                    self.check_message_simple(event, member, rule)
+                self.check_message_simple(event, member, plan, rules, features, duplicates)
             except Violation as v:
                 self.violate(v)
-            finally:
-                self.guild_locks[event.guild.id].release()
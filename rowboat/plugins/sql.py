@@ -1,4 +1,5 @@
-from datetime import datetime, timezone
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 
 import cairosvg
 import gevent
@@ -14,6 +15,8 @@ from disco.types.permissions import Permissions
 from disco.types.user import User as DiscoUser
 from disco.util.emitter import Priority
 from disco.util.snowflake import from_datetime, to_datetime
+from gevent.event import Event
+from gevent.lock import Semaphore
 from gevent.pool import Pool
 
 from rowboat.models.channel import Channel
@@ -22,10 +25,19 @@ from rowboat.models.message import Message, Reaction
 from rowboat.models.user import User
 from rowboat.plugins import CommandFail, CommandSuccess
 from rowboat.plugins import RowboatPlugin as Plugin
-from rowboat.sql import database
-from rowboat.tasks.backfill import backfill_channel, backfill_guild
+from rowboat.sql import CONNECTION_ERRORS, BatchWriter, database, insert_rows
+from rowboat.tasks.backfill import BACKFILL_MODES, backfill_channel, backfill_guild, get_backfill_progress
 from rowboat.util.input import parse_duration
 from rowboat.util.reqaddons import DiscordStyle
+from rowboat.util.stats import increment
+
+
+# The newest stored message in each of a list of channels, up to a given message
+#  ID per channel, one index probe each
+NEWEST_MESSAGES_SQL = """
+    SELECT c.id, (SELECT m.id FROM messages m WHERE m.channel_id = c.id AND m.id <= c.last ORDER BY m.id DESC LIMIT 1)
+    FROM unnest(%s::bigint[], %s::bigint[]) AS c(id, last)
+"""
 
 
 class SQLPlugin(Plugin):
@@ -34,12 +46,55 @@ class SQLPlugin(Plugin):
     def load(self, ctx):
         self.models = ctx.get("models", {})
         self.backfills = {}
+        self.writer = MessageWriter(self.log)
+        self.recovery = GapRecovery(self.log, self.state, self.writer.flush)
+        self.recovery_guilds = set()
         super(SQLPlugin, self).load(ctx)
 
+        self.spawn(self.writer.run)
+        self.spawn(self.recovery.run)
+
     def unload(self, ctx):
         ctx["models"] = self.models
+        self.writer.flush()
         super(SQLPlugin, self).unload(ctx)
 
+    def flush_messages(self, message_id=None):
+        # Externally Used, for readers that need messages from the last few seconds.
+        #  Given a message id, only flushes if that message is still buffered.
+        if message_id is None or self.writer.is_pending(message_id):
+            self.writer.flush()
+
+    def get_message(self, message_id):
+        # Externally Used, recent messages are served from memory
+        msg = Message.get_cached(message_id)
+        if msg:
+            return msg
+
+        self.flush_messages(message_id)
+
+        try:
+            return Message.get(id=message_id)
+        except Message.DoesNotExist:
+            return None
+
+    @Plugin.listen("Ready")
+    def on_ready(self, event):
+        # Guilds arrive after this, their channels are checked for gaps as they do
+        self.recovery_guilds = {guild.id for guild in event.guilds}
+
+    @Plugin.listen("GuildCreate")
+    def on_guild_create(self, event):
+        if event.guild.id not in self.recovery_guilds:
+            return
+
+        self.recovery_guilds.discard(event.guild.id)
+        self.recovery.queue([event.guild])
+
+    @Plugin.listen("Resumed")
+    def on_resumed(self, event):
+        self.recovery.queue(list(self.state.guilds.values()))
+
     #@Plugin.listen("VoiceStateUpdate", priority=Priority.SEQUENTIAL)
     @Plugin.listen("VoiceStateUpdate", priority=Priority.AFTER)
     def on_voice_state_update(self, event):
@@ -64,25 +119,36 @@ class SQLPlugin(Plugin):
         if not updates:
             return
 
+        if User.is_cached(event.user.id, updates.get("username"), updates.get("avatar")):
+            return
+
         User.update(**updates).where((User.user_id == event.user.id)).execute()
+        User.invalidate_cache(event.user.id)
 
     @Plugin.listen("MessageCreate")
     def on_message_create(self, event):
         if event.message.author.bot:
             return
-        Message.from_disco_message(event.message)
+
+        # The author is stored along with the message when the writer flushes
+        row = Message.convert_message(event.message, resolve_author=False)
+        Message.cache_message(row, author=event.message.author)
+        self.writer.create(event.message, row)
 
     @Plugin.listen("MessageUpdate")
     def on_message_update(self, event):
-        Message.from_disco_message_update(event.message)
+        Message.update_cached(event.message)
+        self.writer.update(event.message)
 
     @Plugin.listen("MessageDelete")
     def on_message_delete(self, event):
-        Message.update(deleted=True).where(Message.id == event.id).execute()
+        Message.mark_cached_deleted([event.id])
+        self.writer.delete(event.id)
 
     @Plugin.listen("MessageDeleteBulk")
     def on_message_delete_bulk(self, event):
-        Message.update(deleted=True).where((Message.id << event.ids)).execute()
+        Message.mark_cached_deleted(event.ids)
+        self.writer.delete(*event.ids)
 
     @Plugin.listen("MessageReactionAdd", priority=Priority.BEFORE)
     def on_message_reaction_add(self, event):
@@ -282,17 +348,41 @@ class SQLPlugin(Plugin):
             sum([i._recovered for i in recoveries])
         ))
 
-    @Plugin.command("backfill channel", "[channel:snowflake]", level=-1, global_=True)
-    def command_backfill_channel(self, event, channel=None):
+    @Plugin.command("backfill channel", "[channel:snowflake] [mode:str]", level=-1, global_=True)
+    def command_backfill_channel(self, event, channel=None, mode='resume'):
+        if mode not in BACKFILL_MODES:
+            raise CommandFail("Mode must be one of {}".format(", ".join(BACKFILL_MODES)))
+
         channel = self.state.channels.get(channel) if channel else event.channel
-        backfill_channel.queue(channel.id)
-        raise CommandSuccess("Enqueued channel to be backfilled")
+        backfill_channel.queue(channel.id, mode=mode)
+        raise CommandSuccess("Enqueued channel to be backfilled ({})".format(mode))
+
+    @Plugin.command("backfill guild", "[guild:guild] [mode:str]", level=-1, global_=True)
+    def command_backfill_guild(self, event, guild=None, mode='resume'):
+        if mode not in BACKFILL_MODES:
+            raise CommandFail("Mode must be one of {}".format(", ".join(BACKFILL_MODES)))
 
-    @Plugin.command("backfill guild", "[guild:guild] [concurrency:int]", level=-1, global_=True)
-    def command_backfill_guild(self, event, guild=None, concurrency=1):
         guild = guild or event.guild
-        backfill_guild.queue(guild.id)
-        raise CommandSuccess("Enqueued guild to be backfilled")
+        backfill_guild.queue(guild.id, mode=mode)
+        raise CommandSuccess("Enqueued guild to be backfilled ({})".format(mode))
+
+    @Plugin.command("backfill status", level=-1, global_=True)
+    def command_backfill_status(self, event):
+        running = get_backfill_progress()
+        if not running:
+            raise CommandSuccess("No backfills are running")
+
+        tbl = MessageTable()
+        tbl.set_header("Channel", "Progress", "Scanned", "Inserted", "ETA")
+        for channel_id, progress in sorted(running.items()):
+            tbl.add(
+                channel_id,
+                "{}%".format(progress["percent"]),
+                progress["scanned"],
+                progress["inserted"],
+                "{}s".format(int(progress["eta"] or 0)))
+
+        event.msg.reply(tbl.compile())
 
     @Plugin.command("usage", "<word:str> [amount:int] [unit:str]", level=-1, group="words")
     def words_usage(self, event, word, amount=7, unit="days"):
@@ -397,11 +487,15 @@ class SQLPlugin(Plugin):
 
 
 class Recovery(object):
-    def __init__(self, log, channel, start_dt, end_dt=None):
+    def __init__(self, log, channel, start_dt, end_dt=None, after_id=None, end_id=None, max_messages=None):
         self.log = log
         self.channel = channel
         self.start_dt = start_dt
         self.end_dt = end_dt or datetime.now(timezone.utc)
+        self.after_id = after_id
+        self.end_id = end_id
+        self.max_messages = max_messages
+        self._scanned = 0
         self._recovered = 0
 
     def run(self):
@@ -410,7 +504,7 @@ class Recovery(object):
         msgs = self.channel.messages_iter(
             bulk=True,
             direction=MessageIterator.Direction.DOWN,
-            after=str(from_datetime(self.start_dt))
+            after=str(self.after_id or from_datetime(self.start_dt))
         )
 
         for chunk in msgs:
@@ -421,8 +515,264 @@ class Recovery(object):
                 if msg.author.bot:
                     break
 
+            self._scanned += len(chunk)
             self._recovered += len(Message.from_disco_message_many(chunk, safe=True))
 
+            if self.end_id and chunk[-1].id >= self.end_id:
+                break
+
             if to_datetime(chunk[-1].id) > self.end_dt:
                 break
 
+            if self.max_messages and self._scanned >= self.max_messages:
+                self.log.warning("Stopping recovery on channel %s after %s messages", self.channel.id, self._scanned)
+                break
+
+
+class GapRecovery(object):
+    """
+    Re-fetches the messages channels received while we were disconnected. When
+    we (re)connect each channel's last message ID is recorded, and its gap runs
+    from the newest message we had stored up to that point, capped to `max_age`
+    seconds and `max_messages` messages. Channels we've never stored messages
+    for are left to backfills. Queued guilds are checked `max_guilds` at a time,
+    at most `max_concurrent` channels are recovered at once, and at most
+    `per_guild` of those from the same guild. Channels whose last message ID
+    hasn't moved since they were last checked are skipped.
+    """
+
+    def __init__(self, log, state, flush, max_guilds=2, max_concurrent=4, per_guild=2, max_age=60 * 60 * 24, max_messages=5000):
+        self.log = log
+        self.state = state
+        self.flush = flush
+        self.max_guilds = max_guilds
+        self.per_guild = per_guild
+        self.max_age = max_age
+        self.max_messages = max_messages
+
+        self.lock = Semaphore(max_concurrent)
+        self.running = set()
+
+        self._pending = OrderedDict()
+        self._have = Event()
+
+        # Channel ID -> the last message ID it was checked up to
+        self._checked = {}
+
+    def queue(self, guilds):
+        # Called from the event handler, before any later message moves a channels last_message_id on
+        for guild in guilds:
+            channels = {
+                channel.id: channel.last_message_id for channel in list(guild.channels.values())
+                if channel.last_message_id and
+                self._checked.get(channel.id) != channel.last_message_id and
+                channel.get_permissions(self.state.me.id).can(Permissions.VIEW_CHANNEL, Permissions.READ_MESSAGE_HISTORY)
+            }
+
+            if channels:
+                self._pending[guild.id] = (guild, channels)
+
+        if self._pending:
+            self._have.set()
+
+    def run(self):
+        pool = Pool(self.max_guilds)
+
+        while True:
+            self._have.wait()
+            self._have.clear()
+
+            while self._pending:
+                _, (guild, channels) = self._pending.popitem(last=False)
+                pool.spawn(self.recover_guild, guild, channels)
+
+    def find_gaps(self, guild, channels):
+        channels = {k: v for k, v in list(channels.items()) if k not in self.running}
+        if not channels:
+            return []
+
+        # Messages stored since we connected are newer than the recorded IDs, so they're ignored here
+        ids = list(channels.keys())
+        cursor = database.execute_sql(NEWEST_MESSAGES_SQL, (ids, [channels[i] for i in ids]))
+
+        self._checked.update(channels)
+
+        oldest = from_datetime(datetime.now(timezone.utc) - timedelta(seconds=self.max_age))
+        return [
+            (guild.channels.get(channel_id), max(newest, oldest), channels[channel_id])
+            for channel_id, newest in cursor.fetchall()
+            if newest and newest < channels[channel_id] and guild.channels.get(channel_id)
+        ]
+
+    def recover_channel(self, channel, after_id, end_id):
+        with self.lock:
+            recovery = Recovery(
+                self.log,
+                channel,
+                to_datetime(after_id),
+                after_id=after_id,
+                end_id=end_id,
+                max_messages=self.max_messages)
+
+            try:
+                recovery.run()
+            except Exception:
+                self.log.exception("Failed to recover channel %s", channel.id)
+            finally:
+                self.running.discard(channel.id)
+
+        increment("rowboat.recovery.messages", recovery._recovered)
+        return recovery._recovered
+
+    def recover_guild(self, guild, channels):
+        try:
+            # Anything buffered from before we (re)connected needs to be stored before we look for gaps
+            self.flush()
+            gaps = self.find_gaps(guild, channels)
+        except Exception:
+            self.log.exception("Failed to find message gaps in guild %s", guild.id)
+            return
+
+        if not gaps:
+            return
+
+        self.log.info("Recovering messages in %s channels of guild %s", len(gaps), guild.id)
+        increment("rowboat.recovery.channels", len(gaps))
+
+        pool = Pool(self.per_guild)
+        for channel, after_id, end_id in gaps:
+            self.running.add(channel.id)
+            pool.spawn(self.recover_channel, channel, after_id, end_id)
+        pool.join()
+
+
+class MessageWriter(BatchWriter):
+    """
+    Write-behind buffer for gateway message events. Creates, edits and deletes
+    are queued and written in batches. Creates are always inserted before
+    edits or deletes are applied, so an edit or delete can never land before
+    the message it refers to.
+    """
+    def __init__(self, log, flush_size=250, flush_interval=1, max_size=5000):
+        super(MessageWriter, self).__init__(flush_size, flush_interval, max_size, log=log)
+
+        self._creates = OrderedDict()
+        self._updates = list()
+        self._deletes = OrderedDict()
+
+    def __len__(self):
+        return len(self._creates) + len(self._updates) + len(self._deletes)
+
+    def is_pending(self, message_id):
+        return message_id in self._creates
+
+    def create(self, message, row=None):
+        if message.id not in self._creates:
+            self._creates[message.id] = (message, row)
+        self._check_size()
+
+    def update(self, message):
+        if not message.edited_timestamp:
+            return
+
+        self._updates.append(message)
+        self._check_size()
+
+    def delete(self, *ids):
+        for mid in ids:
+            self._deletes[mid] = True
+        self._check_size()
+
+    def _take(self):
+        creates, self._creates = self._creates, OrderedDict()
+        updates, self._updates = self._updates, list()
+        deletes, self._deletes = self._deletes, OrderedDict()
+        return creates, updates, deletes
+
+    def _drop(self, count):
+        while count and self._creates:
+            self._creates.popitem(last=False)
+            count -= 1
+
+        dropped, self._updates = self._updates[:count], self._updates[count:]
+        count -= len(dropped)
+
+        while count and self._deletes:
+            self._deletes.popitem(last=False)
+            count -= 1
+
+    def _write(self, pending):
+        creates, updates, deletes = pending
+
+        requeued = set()
+        if creates:
+            requeued = self._flush_creates(list(creates.values()), deletes)
+
+        for message in updates:
+            # The edit has to wait for its message to be stored
+            if message.id in requeued:
+                self._updates.append(message)
+                continue
+
+            try:
+                Message.from_disco_message_update(message)
+            except CONNECTION_ERRORS:
+                self.log.exception("Failed to apply message update %s, requeueing: ", message.id)
+                self._updates.append(message)
+            except Exception:
+                self.log.exception("Failed to apply message update %s: ", message.id)
+
+        if deletes:
+            try:
+                Message.update(deleted=True).where((Message.id << list(deletes.keys()))).execute()
+            except Exception:
+                self.log.exception("Failed to mark %s messages deleted, requeueing: ", len(deletes))
+                for mid in deletes:
+                    self._deletes.setdefault(mid, True)
+
+    def _requeue_creates(self, creates):
+        # Back at the front, they're older than anything added since
+        for mid, entry in reversed(creates):
+            if mid not in self._creates:
+                self._creates[mid] = entry
+                self._creates.move_to_end(mid, last=False)
+
+    def _flush_creates(self, messages, deletes):
+        """
+        Inserts new messages, returning the IDs of those which were requeued.
+        """
+        # Authors and mentioned users are ensured once per batch instead of
+        #  once per message
+        users = {}
+        for message, _ in messages:
+            users[message.author.id] = message.author
+            users.update(message.mentions)
+
+        for user in list(users.values()):
+            try:
+                User.from_disco_user(user)
+            except CONNECTION_ERRORS:
+                self.log.exception("Failed to store users for %s messages: ", len(messages))
+                break
+            except Exception:
+                self.log.exception("Failed to store user %s: ", user.id)
+
+        requeued = set()
+        for idx in range(0, len(messages), self.flush_size):
+            batch = {
+                message.id: (message, dict(row) if row else Message.convert_message(message, resolve_author=False))
+                for message, row in messages[idx:idx + self.flush_size]
+            }
+
+            rows = [row for _, row in list(batch.values())]
+            for row in rows:
+                if row["id"] in deletes:
+                    row["deleted"] = True
+
+            def requeue(failed):
+                requeued.update(row["id"] for row in failed)
+                self._requeue_creates([(row["id"], batch[row["id"]]) for row in failed])
+
+            self._requeue_failed(rows, insert_rows(Message, rows), requeue)
+
+        return requeued
@@ -450,6 +450,9 @@ class StarboardPlugin(Plugin):
 
     @Plugin.listen('MessageReactionAdd', conditional=is_star_event)
     def on_message_reaction_add(self, event):
+        # Messages are written in batches, make sure a recent one has landed
+        self.get_safe_plugin('SQLPlugin').flush_messages(event.message_id)
+
         try:
             # Grab the message, and JOIN across blocks to check if a block exists
             #  for either the message author or the reactor.
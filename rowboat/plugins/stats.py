@@ -5,6 +5,8 @@ from disco.types.channel import ChannelType
 
 from rowboat import ENV
 from rowboat.plugins import RowboatPlugin as Plugin
+from rowboat.util.cache import CACHES
+from rowboat.util.context import collect_context_stats
 
 
 def to_tags(obj):
@@ -62,6 +64,25 @@ class StatsPlugin(Plugin):
         statsd.gauge("disco.state.channels", len(self.state.channels))
         statsd.gauge("disco.state.users", len(self.state.users))
 
+        # Track our in-process caches
+        for name, cache in list(CACHES.items()):
+            tags = to_tags({"cache": name})
+            statsd.gauge("rowboat.cache.size", len(cache), tags=tags)
+            if hasattr(cache, "bytes"):
+                statsd.gauge("rowboat.cache.bytes", cache.bytes, tags=tags)
+            for counter, value in cache.collect_stats().items():
+                statsd.increment("rowboat.cache.{}".format(counter), value, tags=tags)
+
+        # Track how many events each plugin handled or skipped
+        core = self.bot.plugins.get("CorePlugin")
+        if core:
+            for (plugin, result), value in core.collect_dispatch_stats().items():
+                statsd.increment("rowboat.dispatch.{}".format(result), value, tags=to_tags({"plugin": plugin}))
+
+        # Track how much per-event work was shared between plugins
+        for (name, result), value in collect_context_stats().items():
+            statsd.increment("rowboat.context.{}".format(result), value, tags=to_tags({"value": name}))
+
     @Plugin.listen("MessageCreate")
     def on_message_create(self, event):
         if event.author.bot:
@@ -18,16 +18,16 @@ from peewee import DoesNotExist, fn
 from PIL import Image
 
 from rowboat.constants import BADGE_EMOJI, CDN_URL, EMOJI_RE, GREEN_TICK_EMOJI, GREEN_TICK_EMOJI_ID, SNOOZE_EMOJI, STATUS_EMOJI, USER_MENTION_RE, WEB_URL, YEAR_IN_SEC
-from rowboat.models.message import Message, Reminder
+from rowboat.models.message import REMINDERS, Message, Reminder
 from rowboat.models.user import Infraction, User
 from rowboat.plugins import CommandFail, CommandSuccess
 from rowboat.plugins import RowboatPlugin as Plugin
+from rowboat.tasks.delayed import DelayedRunner
 from rowboat.types.plugin import PluginConfig
 from rowboat.util.badges import UserFlags
 from rowboat.util.images import get_dominant_colors_guild, get_dominant_colors_user
 from rowboat.util.input import parse_duration
 from rowboat.util.time import DiscordFormatting, as_discord, as_unix
-from rowboat.util.timing import Eventual
 
 
 def get_status_emoji(presence):
@@ -55,16 +55,17 @@ class UtilitiesConfig(PluginConfig):
 class UtilitiesPlugin(Plugin):
     def load(self, ctx):
         super(UtilitiesPlugin, self).load(ctx)
-        self.reminder_task = Eventual(self.trigger_reminders)
+        self.reminder_runner = DelayedRunner(REMINDERS, self.trigger_reminder_id)
+        self.spawn(self.reminder_runner.run)
         self.spawn_later(10, self.queue_reminders)
 
-    def queue_reminders(self):
-        try:
-            next_reminder = Reminder.select().order_by(Reminder.remind_at.asc()).limit(1).get()
-        except DoesNotExist:
-            return
+    def unload(self, ctx):
+        self.reminder_runner.stop()
+        super(UtilitiesPlugin, self).unload(ctx)
 
-        self.reminder_task.set_next_schedule(next_reminder.remind_at)
+    def queue_reminders(self):
+        # Picks up anything created before the reminder queue existed
+        REMINDERS.schedule_many(Reminder.select(Reminder.message_id, Reminder.remind_at).tuples())
 
     @Plugin.command("coin", group="random", global_=True)
     def coin(self, event):
@@ -368,17 +369,18 @@ class UtilitiesPlugin(Plugin):
     def config_cmd(self, event):
         raise CommandSuccess("{}/guilds/{}/config".format(WEB_URL, event.guild.id))
 
-    def trigger_reminders(self):
-        reminders = Reminder.with_message_join().where((Reminder.remind_at < (datetime.now(timezone.utc) + timedelta(seconds=1))))
-
-        waitables = list()
-        for reminder in reminders:
-            waitables.append(self.spawn(self.trigger_reminder, reminder))
+    def trigger_reminder_id(self, message_id):
+        try:
+            reminder = Reminder.get(message_id=int(message_id))
+        except DoesNotExist:
+            return
 
-        for waitable in waitables:
-            waitable.join()
+        # Snoozed since this was scheduled
+        if as_unix(reminder.remind_at) > as_unix(datetime.now(timezone.utc)):
+            REMINDERS.schedule(reminder.message_id, reminder.remind_at)
+            return
 
-        self.queue_reminders()
+        self.trigger_reminder(reminder)
 
     def trigger_reminder(self, reminder: Reminder):
         message = Message.get(reminder.message_id)
@@ -416,6 +418,7 @@ class UtilitiesPlugin(Plugin):
         if mra_event.emoji.name == SNOOZE_EMOJI:
             reminder.remind_at = datetime.now(timezone.utc) + timedelta(minutes=20)
             reminder.save()
+            REMINDERS.schedule(reminder.message_id, reminder.remind_at)
             msg.edit("Ok, I've snoozed that reminder. You'll get another notification in 20 minutes.")
             return
 
@@ -443,5 +446,5 @@ class UtilitiesPlugin(Plugin):
             raise CommandFail("You need to provide content for the reminder, or reply to a message!")
 
         r = Reminder.create(message_id=event.msg.id, remind_at=remind_at, content=content)
-        self.reminder_task.set_next_schedule(r.remind_at)
+        REMINDERS.schedule(r.message_id, r.remind_at)
         raise CommandSuccess("I'll remind you at <t:{0}:f> (<t:{0}:R>)".format(as_unix(r.remind_at)))
@@ -1,7 +1,12 @@
+import logging
 import os
+import time
+from abc import ABC, abstractmethod
 
 import psycogreen.gevent
-from peewee import OP, Expression, Model, Proxy
+from gevent.event import Event
+from gevent.lock import Semaphore
+from peewee import OP, Expression, InterfaceError, Model, OperationalError, Proxy
 from playhouse.postgres_ext import PostgresqlExtDatabase
 
 from rowboat import ENV
@@ -15,6 +20,12 @@ database = Proxy()
 
 OP["IRGX"] = "irgx"
 
+# Errors which mean the database itself is unreachable or failing, rather than
+#  something being wrong with the rows
+CONNECTION_ERRORS = (InterfaceError, OperationalError)
+
+log = logging.getLogger(__name__)
+
 
 def pg_regex_i(lhs, rhs):
     return Expression(lhs, OP.IRGX, rhs)
@@ -30,6 +41,182 @@ class ModelBase(Model):
         return cls
 
 
+def insert_rows(model, rows):
+    """
+    Inserts rows with a single `insert_many`, falling back to one insert per row
+    when that fails so one bad row can't take the rest of the batch with it.
+    Rows which conflict with existing ones are dropped. Returns the rows which
+    could not be inserted. If the database can't be reached the rows aren't
+    retried at all, as every one of them would fail the same way.
+    """
+    try:
+        model.insert_many(rows).on_conflict_ignore().execute()
+        return []
+    except CONNECTION_ERRORS:
+        log.exception("Failed to insert batch of %s %s rows, database unavailable: ", len(rows), model.__name__)
+        return list(rows)
+    except Exception:
+        log.exception("Failed to insert batch of %s %s rows, retrying one by one: ", len(rows), model.__name__)
+
+    failed = []
+    for row in rows:
+        try:
+            model.insert(row).on_conflict_ignore().execute()
+        except Exception:
+            failed.append(row)
+    return failed
+
+
+class BatchWriter(ABC):
+    """
+    Base for write-behind buffers. Pending writes are flushed every
+    `flush_interval` seconds or as soon as `flush_size` are waiting, and once
+    `max_size` are waiting callers flush themselves rather than letting the
+    buffer grow. Flushes are serialized. Subclasses hold the pending writes,
+    `_take` swaps them all out, `_write` writes them and `_drop` throws away
+    the oldest.
+
+    When a write fails outright (the database is likely down) flushing backs
+    off exponentially, up to `max_backoff` seconds, and while backing off a
+    full buffer drops its oldest writes instead of flushing inline.
+    """
+
+    def __init__(self, flush_size, flush_interval, max_size=None, max_backoff=60, log=log):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.max_backoff = max_backoff
+        self.log = log
+
+        self._have = Event()
+        self._lock = Semaphore()
+
+        self._failures = 0
+        self._retry_at = 0
+
+    @abstractmethod
+    def __len__(self):
+        pass
+
+    @abstractmethod
+    def _take(self):
+        pass
+
+    @abstractmethod
+    def _write(self, pending):
+        pass
+
+    @abstractmethod
+    def _drop(self, count):
+        pass
+
+    @property
+    def backing_off(self):
+        return time.time() < self._retry_at
+
+    def _write_failed(self):
+        self._failures += 1
+        delay = min(self.max_backoff, self.flush_interval * 2 ** self._failures)
+        self._retry_at = time.time() + delay
+        self.log.warning("%s failed to write %s times in a row, backing off for %ss",
+                         type(self).__name__, self._failures, delay)
+
+    def _check_size(self):
+        size = len(self)
+
+        if self.max_size and size >= self.max_size:
+            if self.backing_off:
+                # Flushing would just fail again, so shed the oldest writes (a
+                #  batch at a time, rather than one on every call)
+                count = size - self.max_size + self.flush_size
+                self._drop(count)
+                self.log.error("%s is full while the database is unavailable, dropped %s writes",
+                               type(self).__name__, count)
+            else:
+                # Apply backpressure to the caller rather than growing without
+                #  bound when the database can't keep up.
+                self.flush()
+        elif size >= self.flush_size and not self.backing_off:
+            self._have.set()
+
+    def _requeue_failed(self, rows, failed, requeue):
+        """
+        Puts rows which failed to insert back in the buffer, if none of the batch
+        went in (the database is more likely down than every row bad), or drops
+        them otherwise.
+        """
+        if not failed:
+            return
+
+        dropped = failed
+        if len(failed) == len(rows):
+            self._write_failed()
+            room = max(0, self.max_size - len(self)) if self.max_size else len(failed)
+            requeue(failed[:room])
+            dropped = failed[room:]
+
+        if dropped:
+            self.log.error("%s dropped %s rows which could not be inserted", type(self).__name__, len(dropped))
+
+    def run(self):
+        while True:
+            self._have.wait(timeout=max(self.flush_interval, self._retry_at - time.time()))
+            self._have.clear()
+
+            if self.backing_off:
+                continue
+
+            try:
+                self.flush()
+            except Exception:
+                self.log.exception("Failed to flush %s: ", type(self).__name__)
+
+    def flush(self):
+        with self._lock:
+            if not len(self):
+                return
+
+            failures = self._failures
+            self._write(self._take())
+
+            # Nothing failed outright this time, so the database is back
+            if self._failures == failures:
+                self._failures = 0
+                self._retry_at = 0
+
+
+class BatchInserter(BatchWriter):
+    """
+    Buffers rows for a model and writes them with a single `insert_many`.
+    """
+
+    def __init__(self, model, flush_size=100, flush_interval=5, max_size=5000):
+        super(BatchInserter, self).__init__(flush_size, flush_interval, max_size)
+        self.model = model
+        self._rows = []
+
+    def __len__(self):
+        return len(self._rows)
+
+    def add(self, row):
+        self._rows.append(row)
+        self._check_size()
+
+    def _take(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def _write(self, rows):
+        self._requeue_failed(rows, insert_rows(self.model, rows), self._requeue)
+
+    def _requeue(self, rows):
+        # Back at the front, they're older than anything added since
+        self._rows[:0] = rows
+
+    def _drop(self, count):
+        del self._rows[:count]
+
+
 def init_db(env):
     if env == "docker":
         database.initialize(
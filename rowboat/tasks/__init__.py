@@ -3,16 +3,57 @@ import logging
 import os
 import time
 import uuid
+from collections import Counter
 
 import gevent
 from gevent.lock import Semaphore
+from redis.exceptions import LockError
 
 from rowboat.redis import rdb
+from rowboat.util.stats import increment, statsd
 
 log = logging.getLogger(__name__)
 
 TASKS = {}
 
+# A job is moved from the queue onto its task's processing list while it runs,
+#  with a lease (in a sorted set, scored by expiry) which the runner keeps
+#  renewing. Failed jobs wait in the delayed set before being retried, and end
+#  up on the dead list once they run out of attempts.
+QUEUE_KEY = 'task_queue:{}'
+PROCESSING_KEY = 'task_processing:{}'
+LEASES_KEY = 'task_leases:{}'
+DELAYED_KEY = 'task_delayed:{}'
+DEAD_KEY = 'task_dead:{}'
+
+# Each worker process publishes its job counts here, for the pool supervisor
+WORKER_STATS_KEY = 'task_worker:{}'
+
+# Takes a job off the processing list (if it's still there) and either dead
+#  letters it (no score) or schedules it to be retried
+RELEASE_SCRIPT = rdb.register_script('''
+if redis.call('LREM', KEYS[1], 1, ARGV[1]) == 0 then
+    return 0
+end
+redis.call('ZREM', KEYS[2], ARGV[1])
+if ARGV[3] == '' then
+    redis.call('RPUSH', KEYS[3], ARGV[2])
+else
+    redis.call('ZADD', KEYS[3], ARGV[3], ARGV[2])
+end
+return 1
+''')
+
+# Moves delayed jobs which are due back onto the queue
+PROMOTE_SCRIPT = rdb.register_script('''
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, job in ipairs(due) do
+    redis.call('ZREM', KEYS[1], job)
+    redis.call('RPUSH', KEYS[2], job)
+end
+return #due
+''')
+
 
 def get_client():
     from disco.client import Client, ClientConfig
@@ -41,14 +82,31 @@ def task(*args, **kwargs):
     return deco
 
 
+def load_tasks():
+    for f in os.listdir(os.path.dirname(os.path.abspath(__file__))):
+        if f.endswith('.py') and not f.startswith('__'):
+            __import__('rowboat.tasks.' + f.rsplit('.')[0])
+    return TASKS
+
+
 class Task(object):
-    def __init__(self, name, method, max_concurrent=None, buffer_time=None, max_queue_size=25, global_lock=None):
+    def __init__(self, name, method, max_concurrent=None, buffer_time=None, max_queue_size=25, global_lock=None,
+                 max_retries=3, retry_backoff=30, visibility_timeout=300):
         self.name = name
         self.method = method
         self.max_concurrent = max_concurrent
         self.max_queue_size = max_queue_size
         self.buffer_time = buffer_time
         self.global_lock = global_lock
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.visibility_timeout = visibility_timeout
+
+        self.queue_key = QUEUE_KEY.format(name)
+        self.processing_key = PROCESSING_KEY.format(name)
+        self.leases_key = LEASES_KEY.format(name)
+        self.delayed_key = DELAYED_KEY.format(name)
+        self.dead_key = DEAD_KEY.format(name)
 
         self.log = log
 
@@ -57,83 +115,275 @@ class Task(object):
 
     def queue(self, *args, **kwargs):
         # Make sure we have space
-        if self.max_queue_size and (rdb.llen('task_queue:%s' % self.name) or 0) > self.max_queue_size:
+        if self.max_queue_size and (rdb.llen(self.queue_key) or 0) > self.max_queue_size:
             raise Exception("Queue for task %s is full!" % self.name)
 
         task_id = str(uuid.uuid4())
-        rdb.rpush('task_queue:%s' % self.name, json.dumps({
+        rdb.rpush(self.queue_key, json.dumps({
             'id': task_id,
             'args': args,
-            'kwargs': kwargs
+            'kwargs': kwargs,
+            'attempts': 0,
+            'queued_at': time.time(),
         }))
         return task_id
 
+    def get_retry_delay(self, attempts):
+        return self.retry_backoff * (2 ** (attempts - 1))
+
 
 class TaskRunner(object):
     def __init__(self, name, task):
         self.name = name
         self.task = task
-        self.lock = Semaphore(task.max_concurrent)
+        self.lock = Semaphore(task.max_concurrent) if task.max_concurrent else None
+        self.active = True
+        self.counts = Counter()
+
+        # Jobs seen on the processing list without a lease during the last sweep
+        self.orphans = set()
+
+    def claim(self, timeout=1):
+        raw = rdb.blmove(self.task.queue_key, self.task.processing_key, timeout, 'LEFT', 'RIGHT')
+        if raw is not None:
+            rdb.zadd(self.task.leases_key, {raw: time.time() + self.task.visibility_timeout})
+        return raw
+
+    def consume(self):
+        while self.active:
+            # Only take a job once there's room to run it, so the rest stay in the queue
+            if self.lock:
+                self.lock.acquire()
+
+            try:
+                raw = self.claim()
+            except Exception:
+                log.exception('Failed to claim job for %s', self.name)
+                raw = None
+                gevent.sleep(1)
+
+            if raw is None:
+                if self.lock:
+                    self.lock.release()
+                continue
+
+            gevent.spawn(self.run, raw)
+
+    def heartbeat(self, raw, locks):
+        interval = self.task.visibility_timeout / 3.0
+
+        while True:
+            gevent.sleep(interval)
+            rdb.zadd(self.task.leases_key, {raw: time.time() + self.task.visibility_timeout}, xx=True)
+            for lock in locks:
+                lock.reacquire()
 
     def process(self, job):
-        log.info('[%s] Running job %s...', job['id'], self.name)
+        log.info('[%s] Running job %s (attempt %s)...', job['id'], self.name, job.get('attempts', 0) + 1)
         start = time.time()
 
+        if job.get('queued_at'):
+            statsd.timing('rowboat.tasks.latency', (start - job['queued_at']) * 1000, tags=['task:{}'.format(self.name)])
+
         try:
             self.task(*job['args'], **job['kwargs'])
             if self.task.buffer_time:
                 time.sleep(self.task.buffer_time)
         except:
             log.exception('[%s] Failed in %ss', job['id'], time.time() - start)
+            raise
+        finally:
+            statsd.timing('rowboat.tasks.duration', (time.time() - start) * 1000, tags=['task:{}'.format(self.name)])
 
         log.info('[%s] Completed in %ss', job['id'], time.time() - start)
 
-    def run(self, job):
-        lock = None
-        if self.task.global_lock:
-            lock = rdb.lock('{}:{}'.format(
-                self.task.name,
-                self.task.global_lock(
-                    *job['args'],
-                    **job['kwargs']
-                )
-            ))
-            lock.acquire()
-
-        if self.task.max_concurrent:
-            self.lock.acquire()
-
-        self.process(job)
+    def run(self, raw):
+        job = json.loads(raw)
+        locks = []
+        heartbeat = gevent.spawn(self.heartbeat, raw, locks)
 
-        if lock:
-            lock.release()
-
-        if self.task.max_concurrent:
-            self.lock.release()
+        try:
+            if self.task.global_lock:
+                lock = rdb.lock('{}:{}'.format(
+                    self.task.name,
+                    self.task.global_lock(
+                        *job['args'],
+                        **job['kwargs']
+                    )
+                ), timeout=self.task.visibility_timeout)
+                lock.acquire()
+                locks.append(lock)
+
+            self.process(job)
+        except Exception as e:
+            self.fail(raw, job, repr(e))
+        else:
+            self.ack(raw, job)
+        finally:
+            heartbeat.kill()
+
+            for lock in locks:
+                try:
+                    lock.release()
+                except LockError:
+                    log.warning('[%s] Global lock for %s expired before it was released', job['id'], self.name)
+
+            if self.lock:
+                self.lock.release()
+
+    def ack(self, raw, job):
+        pipe = rdb.pipeline()
+        pipe.lrem(self.task.processing_key, 1, raw)
+        pipe.zrem(self.task.leases_key, raw)
+        removed, _ = pipe.execute()
+
+        if not removed:
+            log.warning('[%s] Job %s finished after its lease expired, it may have run twice', job['id'], self.name)
+
+        self.counts['completed'] += 1
+        increment('rowboat.tasks.completed', tags={'task': self.name})
+
+    def fail(self, raw, job, error):
+        job = dict(job, attempts=job.get('attempts', 0) + 1, error=error)
+
+        if job['attempts'] > self.task.max_retries:
+            released = RELEASE_SCRIPT(
+                keys=[self.task.processing_key, self.task.leases_key, self.task.dead_key],
+                args=[raw, json.dumps(job), ''])
+            if released:
+                log.error('[%s] Job %s failed %s times, moved to %s', job['id'], self.name, job['attempts'], self.task.dead_key)
+                increment('rowboat.tasks.dead', tags={'task': self.name})
+        else:
+            delay = self.task.get_retry_delay(job['attempts'])
+            released = RELEASE_SCRIPT(
+                keys=[self.task.processing_key, self.task.leases_key, self.task.delayed_key],
+                args=[raw, json.dumps(job), time.time() + delay])
+            if released:
+                log.warning('[%s] Retrying job %s in %ss', job['id'], self.name, delay)
+                increment('rowboat.tasks.retried', tags={'task': self.name})
+
+        # Otherwise someone else (e.g. another worker's sweep) already released it, and counted it
+        if released:
+            self.counts['failed'] += 1
+            increment('rowboat.tasks.failed', tags={'task': self.name})
+
+    def sweep(self):
+        """
+        Requeues jobs whose lease expired (their worker died or hung) or which
+        never got one, and moves retries which are due back onto the queue.
+        """
+        now = time.time()
+
+        for raw in rdb.zrangebyscore(self.task.leases_key, '-inf', now):
+            self.fail(raw, json.loads(raw), 'visibility timeout expired')
+
+        # A job is claimed before it's leased, so only give up on one which
+        #  has been without a lease for a whole sweep
+        processing = rdb.lrange(self.task.processing_key, 0, -1)
+        pipe = rdb.pipeline()
+        for raw in processing:
+            pipe.zscore(self.task.leases_key, raw)
+
+        orphans = {raw for raw, lease in zip(processing, pipe.execute()) if lease is None}
+        for raw in orphans & self.orphans:
+            self.fail(raw, json.loads(raw), 'orphaned on processing list')
+        self.orphans = orphans
+
+        PROMOTE_SCRIPT(keys=[self.task.delayed_key, self.task.queue_key], args=[now, 100])
+
+    def report(self):
+        pipe = rdb.pipeline()
+        pipe.llen(self.task.queue_key)
+        pipe.llen(self.task.processing_key)
+        pipe.zcard(self.task.delayed_key)
+        pipe.llen(self.task.dead_key)
+
+        tags = ['task:{}'.format(self.name)]
+        for name, value in zip(('queued', 'processing', 'delayed', 'dead'), pipe.execute()):
+            statsd.gauge('rowboat.tasks.{}'.format(name), value, tags=tags)
 
 
 class TaskWorker(object):
-    def __init__(self):
-        self.load()
-        self.queues = ['task_queue:' + i for i in list(TASKS.keys())]
-        self.runners = {k: TaskRunner(k, v) for k, v in list(TASKS.items())}
+    """
+    Runs the given task queues (or all of them) in this process. Several
+    workers may consume the same queue, each claims jobs independently.
+    """
+
+    def __init__(self, worker_id=0, queues=None, sweep_interval=15):
+        tasks = self.load()
+        if queues:
+            unknown = set(queues) - set(tasks)
+            if unknown:
+                raise Exception('Unknown task queues: %s' % ', '.join(sorted(unknown)))
+            tasks = {k: v for k, v in list(tasks.items()) if k in queues}
+
+        self.worker_id = worker_id
+        self.runners = {k: TaskRunner(k, v) for k, v in list(tasks.items())}
+        self.sweep_interval = sweep_interval
         self.active = True
 
     def load(self):
-        for f in os.listdir(os.path.dirname(os.path.abspath(__file__))):
-            if f.endswith('.py') and not f.startswith('__'):
-                __import__('rowboat.tasks.' + f.rsplit('.')[0])
+        return load_tasks()
 
-    def run(self):
-        log.info('Running TaskManager on %s queues...', len(self.queues))
+    def publish_stats(self):
+        key = WORKER_STATS_KEY.format(self.worker_id)
+        stats = {'pid': os.getpid(), 'updated': time.time()}
+        for runner in list(self.runners.values()):
+            for name in ('completed', 'failed'):
+                stats['{}:{}'.format(runner.name, name)] = runner.counts[name]
 
+        pipe = rdb.pipeline()
+        pipe.hset(key, mapping=stats)
+        pipe.expire(key, self.sweep_interval * 4)
+        pipe.execute()
+
+    def maintain(self):
         while self.active:
-            chan, job = rdb.blpop(self.queues)
-            job_name = chan.decode().split(':', 1)[1]
-            job = json.loads(job)
+            for runner in list(self.runners.values()):
+                try:
+                    runner.sweep()
+                    runner.report()
+                except Exception:
+                    log.exception('Failed to sweep queues for %s', runner.name)
 
-            if job_name not in TASKS:
-                log.error("Cannot handle task %s", job_name)
-                continue
+            try:
+                self.publish_stats()
+            except Exception:
+                log.exception('Failed to publish stats for worker %s', self.worker_id)
 
-            gevent.spawn(self.runners[job_name].run, job)
+            gevent.sleep(self.sweep_interval)
+
+    def stop(self):
+        self.active = False
+        for runner in list(self.runners.values()):
+            runner.active = False
+
+    def run(self):
+        log.info('Running TaskManager on %s queues (%s)...', len(self.runners), ', '.join(sorted(self.runners)))
+
+        greenlets = [gevent.spawn(runner.consume) for runner in list(self.runners.values())]
+        greenlets.append(gevent.spawn(self.maintain))
+        gevent.joinall(greenlets)
+
+
+def get_worker_stats(worker_ids):
+    """
+    Returns the job counts last published by each of the given workers, as
+    `{worker_id: {(task, 'completed' | 'failed'): count}}`. Workers which
+    haven't published recently are left out.
+    """
+    pipe = rdb.pipeline()
+    for worker_id in worker_ids:
+        pipe.hgetall(WORKER_STATS_KEY.format(worker_id))
+
+    result = {}
+    for worker_id, data in zip(worker_ids, pipe.execute()):
+        if not data:
+            continue
+
+        counts = result[worker_id] = {}
+        for field, value in list(data.items()):
+            field = field.decode('utf-8')
+            if ':' in field:
+                counts[tuple(field.rsplit(':', 1))] = int(value)
+    return result
@@ -1,19 +1,135 @@
+import json
+import time
+
 from disco.types.channel import MessageIterator
+from disco.util.snowflake import to_unix
+from peewee import fn
 
 from rowboat.models.message import Message
+from rowboat.redis import rdb
+from rowboat.util.stats import statsd
 
 from . import get_client, task
 
+# The newest message a channel's backfill got through, per channel
+CHECKPOINTS_KEY = 'backfill:checkpoints'
+
+# Progress of the backfills currently running, per channel
+PROGRESS_KEY = 'backfill:progress'
+
+# How a backfill picks where to start:
+#  full - from the start of the channel, ignoring any checkpoint
+#  resume - from the channel's checkpoint, if it has one
+#  incremental - from the checkpoint or the newest stored message, whichever is newer
+BACKFILL_MODES = ('full', 'resume', 'incremental')
+
+# Log and publish progress every this many chunks
+PROGRESS_INTERVAL = 10
+
+
+def get_checkpoint(channel_id):
+    value = rdb.hget(CHECKPOINTS_KEY, channel_id)
+    return int(value) if value else None
+
+
+def set_checkpoint(channel_id, message_id):
+    rdb.hset(CHECKPOINTS_KEY, channel_id, message_id)
+
+
+def get_backfill_start(channel_id, mode):
+    if mode not in BACKFILL_MODES:
+        raise Exception('Unknown backfill mode %s' % mode)
+
+    if mode == 'full':
+        return 1
+
+    start = get_checkpoint(channel_id) or 1
+    if mode == 'incremental':
+        newest = Message.select(fn.MAX(Message.id)).where(Message.channel_id == channel_id).scalar()
+        start = max(start, newest or 1)
+    return start
+
+
+def get_backfill_progress(channel_id=None):
+    """
+    Returns the progress of the backfill running for a channel, or of all
+    running backfills (by channel) when no channel is given.
+    """
+    if channel_id:
+        value = rdb.hget(PROGRESS_KEY, channel_id)
+        return json.loads(value) if value else None
+
+    return {int(k): json.loads(v) for k, v in list(rdb.hgetall(PROGRESS_KEY).items())}
+
 
-@task(max_concurrent=1, max_queue_size=10, global_lock=lambda guild_id: guild_id)
-def backfill_guild(task, guild_id):
+class BackfillProgress(object):
+    """
+    Estimates how far through a channel a backfill is from the timestamps of
+    the message IDs it has reached, between where it started and the channel's
+    last message.
+    """
+
+    def __init__(self, channel_id, last_message_id):
+        self.channel_id = channel_id
+        self.end = to_unix(last_message_id) if last_message_id else time.time()
+        self.first = None
+        self.current = None
+        self.started = time.time()
+
+        self.scanned = 0
+        self.inserted = 0
+        self.chunks = 0
+
+    def update(self, chunk, inserted):
+        if self.first is None:
+            self.first = to_unix(chunk[0].id)
+
+        self.current = to_unix(chunk[-1].id)
+        self.scanned += len(chunk)
+        self.inserted += inserted
+        self.chunks += 1
+
+    @property
+    def fraction(self):
+        if self.first is None or self.end <= self.first:
+            return 1.0
+        return min(1.0, max(0.0, (self.current - self.first) / (self.end - self.first)))
+
+    @property
+    def eta(self):
+        fraction = self.fraction
+        if not fraction:
+            return None
+        elapsed = time.time() - self.started
+        return elapsed / fraction - elapsed
+
+    def to_dict(self):
+        return {
+            'scanned': self.scanned,
+            'inserted': self.inserted,
+            'percent': round(self.fraction * 100, 2),
+            'eta': self.eta,
+            'updated': time.time(),
+        }
+
+    def publish(self, log):
+        data = self.to_dict()
+        rdb.hset(PROGRESS_KEY, self.channel_id, json.dumps(data))
+        statsd.gauge('rowboat.backfill.percent', data['percent'], tags=['channel:{}'.format(self.channel_id)])
+
+        log.info('Backfill on channel %s is %s%% done (%s scanned, %s inserted), about %ss remaining',
+                 self.channel_id, data['percent'], self.scanned, self.inserted, int(data['eta'] or 0))
+
+
+@task(max_concurrent=1, max_queue_size=10, global_lock=lambda guild_id, mode='resume': guild_id)
+def backfill_guild(task, guild_id, mode='resume'):
     client = get_client()
     for channel in list(client.api.guilds_channels_list(guild_id).values()):
-        backfill_channel.queue(channel.id)
+        backfill_channel.queue(channel.id, mode=mode)
 
 
-@task(max_concurrent=6, max_queue_size=500, global_lock=lambda channel_id: channel_id)
-def backfill_channel(task, channel_id):
+@task(max_concurrent=6, max_queue_size=500, global_lock=lambda channel_id, mode='resume': channel_id)
+def backfill_channel(task, channel_id, mode='resume'):
     client = get_client()
     channel = client.api.channels_get(channel_id)
 
@@ -22,17 +138,31 @@ def backfill_channel(task, channel_id):
     if channel.guild_id:
         client.state.guilds[channel.guild_id] = client.api.guilds_get(channel.guild_id)
 
-    scanned = 0
-    inserted = 0
+    start = get_backfill_start(channel_id, mode)
+    if channel.last_message_id and start >= channel.last_message_id:
+        task.log.info('Backfill on channel %s is already up to date', channel_id)
+        return
+
+    progress = BackfillProgress(channel_id, channel.last_message_id)
 
-    msgs_iter = MessageIterator(client, channel, bulk=True, after=1, direction=MessageIterator.Direction.DOWN)
-    for chunk in msgs_iter:
-        if not chunk:
-            break
-        for msg in chunk:
-            if msg.author.bot:
+    try:
+        msgs_iter = MessageIterator(client, channel, bulk=True, after=start, direction=MessageIterator.Direction.DOWN)
+        for chunk in msgs_iter:
+            if not chunk:
                 break
-        scanned += len(chunk)
-        inserted += len(Message.from_disco_message_many(chunk, safe=True))
-    
-    task.log.info('Completed backfill on channel %s, %s scanned and %s inserted', channel_id, scanned, inserted)
+            for msg in chunk:
+                if msg.author.bot:
+                    break
+
+            progress.update(chunk, len(Message.from_disco_message_many(chunk, safe=True)))
+
+            # Everything up to here is stored, so a retry can pick up from this point
+            set_checkpoint(channel_id, max(msg.id for msg in chunk))
+
+            if progress.chunks % PROGRESS_INTERVAL == 0:
+                progress.publish(task.log)
+    finally:
+        rdb.hdel(PROGRESS_KEY, channel_id)
+
+    task.log.info('Completed backfill on channel %s (from %s), %s scanned and %s inserted',
+                  channel_id, start, progress.scanned, progress.inserted)
@@ -0,0 +1,229 @@
+import logging
+import time
+
+import gevent
+from gevent.event import Event
+from gevent.pool import Pool
+
+from rowboat.redis import rdb
+from rowboat.util.stats import increment, statsd
+from rowboat.util.time import as_unix
+
+log = logging.getLogger(__name__)
+
+# Items wait in the due set scored by when they're due. Claiming moves them to
+#  the leased set, scored by when the claim runs out, and finishing removes
+#  them. Claims which run out (the process died) are moved back to be run again.
+#  Failed items are counted, and end up in the dead set (scored by when they
+#  gave up) once they run out of attempts, until they're trimmed or revived.
+DUE_KEY = 'delayed:{}'
+LEASED_KEY = 'delayed_leased:{}'
+ATTEMPTS_KEY = 'delayed_attempts:{}'
+DEAD_KEY = 'delayed_dead:{}'
+
+# Moves up to ARGV[3] members scored at or below ARGV[1] from KEYS[1] to KEYS[2]
+#  (rescored as ARGV[2], or left as they were if it's empty), returning them
+#  with their original scores
+MOVE_SCRIPT = rdb.register_script('''
+local items = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'WITHSCORES', 'LIMIT', 0, ARGV[3])
+for i = 1, #items, 2 do
+    redis.call('ZREM', KEYS[1], items[i])
+    if ARGV[2] == '' then
+        redis.call('ZADD', KEYS[2], items[i + 1], items[i])
+    else
+        redis.call('ZADD', KEYS[2], ARGV[2], items[i])
+    end
+end
+return items
+''')
+
+
+class DelayedQueue(object):
+    """
+    A durable schedule of keys (e.g. row IDs) which should be handled at some
+    point in the future, stored in Redis so it survives restarts. Scheduling a
+    key which is already queued moves it to the new time.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.due_key = DUE_KEY.format(name)
+        self.leased_key = LEASED_KEY.format(name)
+        self.attempts_key = ATTEMPTS_KEY.format(name)
+        self.dead_key = DEAD_KEY.format(name)
+
+        # Set whenever something is scheduled, so local runners can wake early
+        self.changed = Event()
+
+    def schedule(self, key, when):
+        if not isinstance(when, (int, float)):
+            when = as_unix(when)
+
+        pipe = rdb.pipeline()
+        pipe.zadd(self.due_key, {str(key): when})
+        pipe.hdel(self.attempts_key, str(key))
+        pipe.zrem(self.dead_key, str(key))
+        pipe.execute()
+        self.changed.set()
+
+    def schedule_many(self, items, revive=False):
+        """
+        Schedules many keys at once, skipping any which already gave up unless
+        `revive` is set.
+        """
+        items = {str(key): when if isinstance(when, (int, float)) else as_unix(when) for key, when in items}
+        if items and not revive:
+            keys = list(items.keys())
+            for key, dead in zip(keys, rdb.zmscore(self.dead_key, keys)):
+                if dead is not None:
+                    del items[key]
+
+        if items:
+            pipe = rdb.pipeline()
+            pipe.zadd(self.due_key, items)
+            pipe.hdel(self.attempts_key, *list(items.keys()))
+            if revive:
+                pipe.zrem(self.dead_key, *list(items.keys()))
+            pipe.execute()
+            self.changed.set()
+
+    def cancel(self, key):
+        pipe = rdb.pipeline()
+        pipe.zrem(self.due_key, str(key))
+        pipe.zrem(self.leased_key, str(key))
+        pipe.hdel(self.attempts_key, str(key))
+        pipe.execute()
+
+    def next_due(self):
+        item = rdb.zrange(self.due_key, 0, 0, withscores=True)
+        return item[0][1] if item else None
+
+    def claim(self, window=0, limit=100, lease=300):
+        """
+        Claims everything due within the next `window` seconds (up to `limit`
+        items), returning `(key, due)` pairs.
+        """
+        now = time.time()
+        items = MOVE_SCRIPT(keys=[self.due_key, self.leased_key], args=[now + window, now + lease, limit])
+        return [(items[i].decode('utf-8'), float(items[i + 1])) for i in range(0, len(items), 2)]
+
+    def finish(self, key):
+        pipe = rdb.pipeline()
+        pipe.zrem(self.leased_key, str(key))
+        pipe.hdel(self.attempts_key, str(key))
+        pipe.execute()
+
+    def fail(self, key):
+        """
+        Counts a failed attempt at handling a key, returning how many it's had.
+        """
+        return rdb.hincrby(self.attempts_key, str(key), 1)
+
+    def retry(self, key, delay):
+        pipe = rdb.pipeline()
+        pipe.zrem(self.leased_key, str(key))
+        pipe.zadd(self.due_key, {str(key): time.time() + delay}, nx=True)
+        pipe.execute()
+
+    def kill(self, key):
+        pipe = rdb.pipeline()
+        pipe.zrem(self.leased_key, str(key))
+        pipe.hdel(self.attempts_key, str(key))
+        pipe.zadd(self.dead_key, {str(key): time.time()})
+        pipe.execute()
+
+    def trim_dead(self, max_age):
+        """
+        Forgets keys which gave up more than `max_age` seconds ago.
+        """
+        return rdb.zremrangebyscore(self.dead_key, '-inf', time.time() - max_age)
+
+    def recover(self, limit=1000):
+        """
+        Moves items whose claim ran out back onto the due set.
+        """
+        return len(MOVE_SCRIPT(keys=[self.leased_key, self.due_key], args=[time.time(), time.time(), limit])) // 2
+
+
+class DelayedRunner(object):
+    """
+    Runs `handler(key)` for each key in a `DelayedQueue` once it's due. Keys
+    due within `window` seconds of each other are picked up in one batch and
+    handled concurrently, up to `concurrency` at once. A handler which raises
+    is retried with exponential backoff starting at `retry_delay` seconds, and
+    after `max_attempts` failures the key is moved to the dead set, where it's
+    kept for `dead_max_age` seconds.
+    """
+
+    def __init__(self, queue, handler, window=1, batch_size=100, concurrency=10, poll_interval=30,
+                 lease=300, retry_delay=60, max_attempts=5, dead_max_age=60 * 60 * 24 * 7):
+        self.queue = queue
+        self.handler = handler
+        self.window = window
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+        self.dead_max_age = dead_max_age
+
+        self.pool = Pool(concurrency)
+        self.active = True
+
+    def stop(self):
+        self.active = False
+        self.queue.changed.set()
+
+    def handle(self, key, due):
+        # Claimed a little early as part of the batch
+        delay = due - time.time()
+        if delay > 0:
+            gevent.sleep(delay)
+
+        statsd.timing('rowboat.delayed.lag', max(0, time.time() - due) * 1000, tags=['queue:' + self.queue.name])
+
+        try:
+            self.handler(key)
+        except Exception:
+            attempts = self.queue.fail(key)
+            increment('rowboat.delayed.failed', tags={'queue': self.queue.name})
+
+            if attempts >= self.max_attempts:
+                log.exception('Failed to handle %s from delayed queue %s %s times, giving up', key, self.queue.name, attempts)
+                self.queue.kill(key)
+                increment('rowboat.delayed.dead', tags={'queue': self.queue.name})
+                return
+
+            delay = self.retry_delay * (2 ** (attempts - 1))
+            log.exception('Failed to handle %s from delayed queue %s, retrying in %ss', key, self.queue.name, delay)
+            self.queue.retry(key, delay)
+        else:
+            self.queue.finish(key)
+            increment('rowboat.delayed.handled', tags={'queue': self.queue.name})
+
+    def run(self):
+        while self.active:
+            self.queue.changed.clear()
+
+            try:
+                self.queue.recover()
+                self.queue.trim_dead(self.dead_max_age)
+
+                items = self.queue.claim(self.window, self.batch_size, self.lease)
+                for key, due in items:
+                    self.pool.spawn(self.handle, key, due)
+
+                # A full batch probably means there's more due already
+                if len(items) >= self.batch_size:
+                    continue
+
+                next_due = self.queue.next_due()
+            except Exception:
+                log.exception('Failed to poll delayed queue %s', self.queue.name)
+                next_due = None
+
+            timeout = self.poll_interval
+            if next_due is not None:
+                timeout = max(0, min(timeout, next_due - self.window - time.time()))
+
+            self.queue.changed.wait(timeout)
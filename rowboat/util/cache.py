@@ -0,0 +1,136 @@
+import time
+from collections import OrderedDict
+
+# All named caches, so their counters can be reported by the StatsPlugin
+CACHES = {}
+
+
+class LRUCache(object):
+    """
+    A bounded, least-recently-used mapping which tracks hit, miss and eviction
+    counts. Counters are cumulative, `collect_stats` returns the change since
+    it was last called.
+    """
+
+    def __init__(self, name, max_size):
+        self.name = name
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._data = OrderedDict()
+        self._reported = (0, 0, 0)
+
+        CACHES[name] = self
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key, default=None):
+        # Like get, but without counting or touching the entry
+        return self._data.get(key, default)
+
+    def set(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def clear(self):
+        self._data.clear()
+
+    def collect_stats(self):
+        current = (self.hits, self.misses, self.evictions)
+        delta = tuple(now - before for now, before in zip(current, self._reported))
+        self._reported = current
+        return dict(zip(('hits', 'misses', 'evictions'), delta))
+
+
+class ExpiringCache(LRUCache):
+    """
+    A bounded mapping whose entries expire `max_age` seconds after they were
+    set, or oldest first once there are more than `max_size` of them or their
+    sizes (as given by `sizeof`) add up to more than `max_bytes`. Setting a key
+    again refreshes it.
+    """
+
+    def __init__(self, name, max_size, max_age, max_bytes=None, sizeof=None):
+        super(ExpiringCache, self).__init__(name, max_size)
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda value: 0)
+        self.bytes = 0
+
+    def get(self, key, default=None):
+        self._expire()
+
+        try:
+            _, _, value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        return value
+
+    def peek(self, key, default=None):
+        entry = self._data.get(key)
+        return entry[2] if entry is not None else default
+
+    def set(self, key, value):
+        self.pop(key)
+
+        size = self.sizeof(value)
+        self._data[key] = (time.time(), size, value)
+        self.bytes += size
+
+        self._expire()
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return default
+
+        self.bytes -= entry[1]
+        return entry[2]
+
+    def clear(self):
+        super(ExpiringCache, self).clear()
+        self.bytes = 0
+
+    def _expire(self):
+        cutoff = time.time() - self.max_age
+
+        while self._data:
+            timestamp, size, _ = next(iter(self._data.values()))
+            if (
+                timestamp >= cutoff and
+                len(self._data) <= self.max_size and
+                (not self.max_bytes or self.bytes <= self.max_bytes)
+            ):
+                break
+
+            self._data.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
@@ -0,0 +1,139 @@
+import re
+
+# Triggers made of these can be indexed by their first word, anything else is
+#  treated like a regex command and always tried
+PLAIN_TRIGGER_RE = re.compile(r'^[\w\- ]+$')
+FIRST_WORD_RE = re.compile(r'\S*')
+
+
+def compile_prefixes(commands_config):
+    """
+    Returns the prefixes configured for a guild as a tuple, which can be passed
+    straight to `str.startswith`.
+    """
+    if not commands_config:
+        return ()
+
+    prefix = commands_config.prefix if commands_config.prefix else commands_config.prefixes
+    if not prefix:
+        return ()
+
+    if isinstance(prefix, str):
+        return (prefix, )
+    return tuple(prefix)
+
+
+class CommandMatcher(object):
+    """
+    Finds the commands a message triggers, the same as
+    `Bot.get_commands_for_message`, but without running every command's regex.
+    Messages without a mention or prefix are rejected up front, and only the
+    commands whose trigger (or group) starts the message are tried, found
+    through a trie of triggers and group abbreviations.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+
+        # The bot recompiles this whenever plugins (and so commands) change
+        self._built_for = None
+        self._trie = None
+        self._always = []
+
+    def _build(self):
+        abbrevs = getattr(self.bot, 'group_abbrev', {})
+
+        # Nodes are [children, commands matching exactly here, commands matching any word starting here]
+        trie = [{}, [], []]
+        always = []
+
+        def insert(word, command, prefix):
+            node = trie
+            for char in word.lower():
+                node = node[0].setdefault(char, [{}, [], []])
+            node[2 if prefix else 1].append(command)
+
+        for position, command in enumerate(self.bot.commands):
+            entry = (position, command)
+
+            if command.is_regex or not all(PLAIN_TRIGGER_RE.match(trigger) for trigger in command.triggers):
+                always.append(entry)
+            elif command.group:
+                # Groups can be abbreviated, anything starting with the abbreviation may match
+                insert(abbrevs.get(command.group, command.group), entry, True)
+            else:
+                for trigger in set(trigger.split(' ', 1)[0] for trigger in command.triggers):
+                    insert(trigger, entry, False)
+
+        self._trie = trie
+        self._always = always
+        self._built_for = getattr(self.bot, 'command_matches_re', None)
+
+    def _candidates(self, content):
+        if self._trie is None or self._built_for is not getattr(self.bot, 'command_matches_re', None):
+            self._build()
+
+        candidates = list(self._always)
+
+        node = self._trie
+        for char in FIRST_WORD_RE.match(content).group(0).lower():
+            node = node[0].get(char)
+            if node is None:
+                break
+            candidates.extend(node[2])
+        else:
+            candidates.extend(node[1])
+
+        # Keep the bots own ordering of commands
+        return [command for _, command in sorted(set(candidates), key=lambda entry: entry[0])]
+
+    @staticmethod
+    def could_match(msg, me, require_mention, prefixes):
+        """
+        Cheaply checks whether a message could possibly trigger a command.
+        """
+        # Like the bot, never treat plain messages as commands
+        if not require_mention and not prefixes:
+            return False
+
+        # The bot only insists on the mention in DMs, elsewhere it's just stripped
+        if require_mention and msg.channel.is_dm and not msg.is_mentioned(me):
+            return False
+
+        if prefixes and not require_mention and not msg.content.startswith(prefixes):
+            return False
+
+        return True
+
+    def get_commands_for_message(self, require_mention, prefixes, msg):
+        me = self.bot.client.state.me
+        if not self.could_match(msg, me, require_mention, prefixes):
+            return []
+
+        content = msg.content
+
+        if require_mention:
+            if msg.is_mentioned(me):
+                if msg.guild:
+                    member = msg.guild.get_member(me)
+                    if member:
+                        content = content.replace(member.user.mention, '', 1)
+                else:
+                    content = content.replace(me.mention, '', 1)
+
+            content = content.lstrip()
+
+        if prefixes:
+            for prefix in prefixes:
+                if prefix and content.startswith(prefix):
+                    content = content[len(prefix):]
+                    break
+            else:
+                return []
+
+        options = []
+        for command in self._candidates(content):
+            match = command.compiled_regex.match(content)
+            if match:
+                options.append((command, match))
+        return sorted(options, key=lambda obj: obj[0].group is None)
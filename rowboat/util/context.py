@@ -0,0 +1,99 @@
+from collections import Counter
+
+from rowboat import ENV
+
+# How often each value was computed, versus reused by a later handler
+CONTEXT_STATS = Counter()
+
+
+class EventContext(object):
+    """
+    Facts about an event which several plugins need (the guild config, the
+    author's member and level, the commands a message matches), each computed
+    the first time it's asked for. A context is attached to the event, so every
+    plugin handling that event shares it.
+    """
+
+    def __init__(self, core, event):
+        self.core = core
+        self.event = event
+        self._values = {}
+
+    @classmethod
+    def of(cls, core, event):
+        context = getattr(event, 'context', None)
+        if context is None:
+            context = event.context = cls(core, event)
+        return context
+
+    def _get(self, key, compute):
+        name = key[0] if isinstance(key, tuple) else key
+
+        try:
+            value = self._values[key]
+        except KeyError:
+            value = self._values[key] = compute()
+            CONTEXT_STATS[(name, 'computed')] += 1
+        else:
+            CONTEXT_STATS[(name, 'reused')] += 1
+
+        return value
+
+    @property
+    def guild(self):
+        return getattr(self.event, 'guild', None)
+
+    @property
+    def config(self):
+        def compute():
+            guild = self.guild and self.core.guilds.get(self.guild.id)
+            return guild.get_config() if guild else None
+        return self._get('config', compute)
+
+    @property
+    def member(self):
+        return self._get('member', lambda: self.guild.get_member(self.event.author) if self.guild else None)
+
+    @property
+    def level(self):
+        return self.get_level(self.event.author)
+
+    def get_level(self, user):
+        def compute():
+            if not self.guild:
+                return 0
+
+            # Reuse the author's member rather than fetching it again
+            if user.id == self.event.author.id and self.member:
+                return self.core.get_level(self.guild, self.member)
+            return self.core.get_level(self.guild, user)
+
+        return self._get(('level', user.id), compute)
+
+    @property
+    def commands(self):
+        return self._get('commands', self._compute_commands)
+
+    def _compute_commands(self):
+        matcher, message, config = self.core.command_matcher, self.event.message, self.config
+
+        if config and config.commands:
+            # If the guild has configuration, use that (otherwise use defaults)
+            return matcher.get_commands_for_message(
+                config.commands.mention,
+                self.core.get_dispatch(self.guild.id).prefixes,
+                message)
+        elif ENV != 'prod':
+            return matcher.get_commands_for_message(False, (ENV + '!', ), message)
+        elif self.guild:
+            # Otherwise, default to requiring mentions
+            return matcher.get_commands_for_message(True, (), message)
+        else:
+            # DM's just use the commands (no prefix/mention)
+            return matcher.get_commands_for_message(False, (), message)
+
+
+def collect_context_stats():
+    counts = dict(CONTEXT_STATS)
+    CONTEXT_STATS.clear()
+    return counts
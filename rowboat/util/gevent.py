@@ -1,4 +1,7 @@
+from contextlib import contextmanager
+
 import gevent
+from gevent.lock import Semaphore
 
 
 def wait_many(*args, **kwargs):
@@ -14,3 +17,31 @@ def wait_many(*args, **kwargs):
         for awaitable in args:
             if awaitable.exception:
                 sentry.capture_exception(exc_info=awaitable.exc_info)
+
+
+class KeyedSemaphore(object):
+    """
+    Hands out a Semaphore per key, and drops it again as soon as nothing holds
+    or waits on it, so idle keys don't accumulate.
+    """
+
+    def __init__(self):
+        self._locks = {}
+
+    def __len__(self):
+        return len(self._locks)
+
+    @contextmanager
+    def acquire(self, key):
+        entry = self._locks.get(key)
+        if not entry:
+            entry = self._locks[key] = [Semaphore(), 0]
+
+        entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
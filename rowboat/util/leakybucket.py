@@ -1,4 +1,5 @@
 import time
+from collections import namedtuple
 
 
 def get_ms_time():
@@ -31,6 +32,41 @@ redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", ARGV[1])
 return redis.call("ZCOUNT", KEYS[1], "-inf", "+inf")
 """
 
+# function(keys=[rl_key, ...], args=[now, amount, time_period, max_actions, ttl, ...])
+MULTI_INCR_SCRIPT = """
+local now = tonumber(ARGV[1])
+local result = {}
+
+for idx, key in ipairs(KEYS) do
+  local base = 2 + (idx - 1) * 4
+  local amount = tonumber(ARGV[base])
+  local max_actions = tonumber(ARGV[base + 2])
+
+  -- Clear out expired water drops
+  redis.call("ZREMRANGEBYSCORE", key, "-inf", now - tonumber(ARGV[base + 1]))
+
+  -- Add our keys
+  for i=1,amount do
+    redis.call("ZADD", key, now, now + i)
+  end
+  redis.call("EXPIRE", key, ARGV[base + 3])
+
+  local count = redis.call("ZCARD", key)
+  local first = redis.call("ZRANGE", key, 0, 0)[1] or 0
+  local last = redis.call("ZRANGE", key, -1, -1)[1] or 0
+  table.insert(result, {count, first, last})
+
+  -- Buckets after a full one are left untouched, like a chain of checks would
+  if max_actions > 0 and count >= max_actions then
+    break
+  end
+end
+
+return result
+"""
+
+BucketState = namedtuple('BucketState', ('count', 'size'))
+
 
 class LeakyBucket(object):
     def __init__(self, redis, key_fmt, max_actions, time_period):
@@ -76,3 +112,45 @@ class LeakyBucket(object):
         if len(res) <= 1:
             return 0
         return (res[-1] - res[0]) / 1000.0
+
+
+class LeakyBucketBatch(object):
+    """
+    Increments and reads any number of leaky buckets, each with its own key,
+    window and amount, in a single script call.
+    """
+
+    def __init__(self, redis):
+        self._script = redis.register_script(MULTI_INCR_SCRIPT)
+
+    def check(self, entries, stop_on_full=True):
+        """
+        Takes a list of `(bucket, key, amount)` and returns a `BucketState` for
+        each of them. When `stop_on_full` is set, evaluation stops at the first
+        bucket which is full, and the result only covers the buckets up to and
+        including that one.
+        """
+        if not entries:
+            return []
+
+        now = get_ms_time()
+        keys, args = [], [now]
+
+        for bucket, key, amount in entries:
+            keys.append(bucket.key_fmt.format(key))
+            args.extend([
+                amount,
+                bucket.time_period,
+                bucket.max_actions if stop_on_full else 0,
+                int((bucket.time_period * 2) / 1000),
+            ])
+
+        result = []
+        for count, first, last in self._script(keys=keys, args=args):
+            size = (int(last) - int(first)) / 1000.0 if count > 1 else 0
+            result.append(BucketState(int(count), size))
+        return result
+
+    @staticmethod
+    def is_full(bucket, state):
+        return state.count >= bucket.max_actions
@@ -0,0 +1,32 @@
+class LevelIndex(object):
+    """
+    A guild's `levels` config compiled for lookups. The level for a set of
+    roles is computed once and remembered, a member's roles changing gives a
+    new key, and a config reload builds a new index.
+    """
+
+    def __init__(self, levels, max_size=4096):
+        self.levels = dict(levels or {})
+        self.max_size = max_size
+        self._roles = {}
+
+    def get_level(self, member):
+        # User ID overrides should override all others
+        if member.id in self.levels:
+            return self.levels[member.id]
+
+        if not self.levels:
+            return 0
+
+        key = tuple(member.roles)
+        try:
+            return self._roles[key]
+        except KeyError:
+            pass
+
+        if len(self._roles) >= self.max_size:
+            self._roles.clear()
+
+        levels = self.levels
+        level = self._roles[key] = max([0] + [levels[oid] for oid in key if oid in levels])
+        return level
@@ -0,0 +1,132 @@
+from collections import deque
+
+from rowboat.util.cache import LRUCache
+
+# Matchers are shared between every config with the same word lists
+MATCHERS = LRUCache('matchers', 1024)
+
+
+def is_word_char(char):
+    return char.isalnum() or char == '_'
+
+
+class MultiMatcher(object):
+    """
+    An Aho-Corasick automaton over a set of case-insensitive patterns. Tokens
+    match anywhere, words only where they are surrounded by word boundaries
+    (the same rule as a `\\b` in a regex). A scan is linear in the length of
+    the text, no matter how many patterns there are.
+    """
+
+    def __init__(self, tokens=(), words=()):
+        # Nodes are stored as parallel lists of transitions, fail links and
+        #  outputs. Outputs are (pattern length, boundaries) where boundaries is
+        #  None for tokens, or whether a word starts and ends with a word char.
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+
+        for token in tokens:
+            self._add(token.lower(), False)
+
+        for word in words:
+            self._add(word.lower(), True)
+
+        self._build()
+
+    @classmethod
+    def get(cls, tokens=(), words=()):
+        key = (tuple(sorted(set(tokens))), tuple(sorted(set(words))))
+        matcher = MATCHERS.get(key)
+        if not matcher:
+            matcher = cls(*key)
+            MATCHERS.set(key, matcher)
+        return matcher
+
+    def _add(self, pattern, word):
+        if not pattern:
+            return
+
+        node = 0
+        for char in pattern:
+            nxt = self._goto[node].get(char)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][char] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            node = nxt
+
+        self._out[node].append((len(pattern), (is_word_char(pattern[0]), is_word_char(pattern[-1])) if word else None))
+
+    def _build(self):
+        queue = deque(self._goto[0].values())
+
+        while queue:
+            node = queue.popleft()
+            for char, nxt in self._goto[node].items():
+                queue.append(nxt)
+
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+
+                self._fail[nxt] = self._goto[fail].get(char, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    @staticmethod
+    def _fold(text):
+        folded = text.lower()
+        if len(folded) == len(text):
+            return folded
+
+        # Some characters lower to more than one, keep offsets lined up
+        return ''.join(char.lower()[0] for char in text)
+
+    def _iter_matches(self, text):
+        folded = self._fold(text)
+        goto, fail, out = self._goto, self._fail, self._out
+        size = len(text)
+
+        node = 0
+        for end, char in enumerate(folded, 1):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+
+            for length, boundaries in out[node]:
+                start = end - length
+
+                # A boundary sits between a word char and a non-word char
+                if boundaries:
+                    if (start > 0 and is_word_char(text[start - 1])) == boundaries[0]:
+                        continue
+                    if (end < size and is_word_char(text[end])) == boundaries[1]:
+                        continue
+
+                yield start, end
+
+    def search(self, text):
+        """
+        Returns whether any pattern is in the text.
+        """
+        for _ in self._iter_matches(text):
+            return True
+        return False
+
+    def findall(self, text):
+        """
+        Returns the non-overlapping matches in the text, leftmost first and
+        preferring the longest pattern at each position.
+        """
+        matches = sorted(self._iter_matches(text), key=lambda m: (m[0], -m[1]))
+
+        result = []
+        position = 0
+        for start, end in matches:
+            if start < position:
+                continue
+            result.append(text[start:end])
+            position = end
+        return result
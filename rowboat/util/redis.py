@@ -1,52 +1,237 @@
+import json
+import logging
+import time
+from abc import ABC, abstractmethod
+
 import gevent
 from gevent.lock import Semaphore
 
+log = logging.getLogger(__name__)
+
+
+def decode(value, typ):
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    return typ(value)
+
 
-class RedisSet(object):
-    def __init__(self, rdb, key_name):
+class ReplicatedCollection(ABC):
+    """
+    A local copy of a Redis collection, kept in sync over pubsub. Every write
+    bumps a version number which is published along with it. A replica which
+    sees a gap in the versions, or (re)subscribes, reloads the whole collection,
+    as it does every `resync_interval` seconds to pick up writes made directly
+    against Redis. Members are converted with the given types instead of being
+    left as bytes.
+    """
+    channel_prefix = None
+
+    def __init__(self, rdb, key_name, listen=True, resync_interval=300):
         self.rdb = rdb
         self.key_name = key_name
-        self.update_key_name = "redis-set:{}".format(self.key_name)
+        self.update_key_name = '{}:{}'.format(self.channel_prefix, key_name)
+        self.version_key_name = '{}:version'.format(self.update_key_name)
+        self.resync_interval = resync_interval
 
-        self._set = rdb.smembers(key_name)
+        self.version = 0
         self._lock = Semaphore()
-        self._ps = self.rdb.pubsub()
-        self._ps.subscribe(self.update_key_name)
 
-        self._inst = gevent.spawn(self._listener)
+        self.resync()
+
+        self._inst = gevent.spawn(self._listener) if listen else None
+
+    def close(self):
+        if self._inst:
+            self._inst.kill()
+            self._inst = None
+
+    def resync(self):
+        with self._lock:
+            pipe = self.rdb.pipeline()
+            pipe.get(self.version_key_name)
+            self._load(pipe)
+            version, data = pipe.execute()
+
+            self.version = int(version or 0)
+            self._replace(data)
+
+    def _write(self, op, *args):
+        with self._lock:
+            pipe = self.rdb.pipeline()
+            self._apply_remote(pipe, op, args)
+            pipe.incr(self.version_key_name)
+            version = pipe.execute()[-1]
+
+            self.rdb.publish(self.update_key_name, json.dumps({'version': version, 'op': op, 'args': args}))
+
+            if version == self.version + 1:
+                self.version = version
+                self._apply_local(op, args)
+                return
+
+        # Someone else wrote in between, and we haven't seen it yet
+        self.resync()
+
+    def _on_update(self, update):
+        with self._lock:
+            if update['version'] <= self.version:
+                return
+
+            if update['version'] == self.version + 1:
+                self.version = update['version']
+                self._apply_local(update['op'], update['args'])
+                return
+
+        self.resync()
+
+    def _listener(self):
+        while True:
+            ps = self.rdb.pubsub()
+            try:
+                ps.subscribe(self.update_key_name)
+
+                # Anything written while we weren't subscribed is picked up here
+                self.resync()
+                resync_at = time.time() + self.resync_interval
+
+                while True:
+                    item = ps.get_message(timeout=1.0)
+                    if item and item['type'] == 'message':
+                        self._on_update(json.loads(item['data']))
+
+                    if time.time() > resync_at:
+                        self.resync()
+                        resync_at = time.time() + self.resync_interval
+            except gevent.GreenletExit:
+                raise
+            except Exception:
+                log.exception('Replica of %s lost its subscription, resubscribing: ', self.update_key_name)
+                gevent.sleep(1)
+            finally:
+                ps.close()
+
+    @abstractmethod
+    def _load(self, pipe):
+        pass
+
+    @abstractmethod
+    def _replace(self, data):
+        pass
+
+    @abstractmethod
+    def _apply_remote(self, pipe, op, args):
+        pass
+
+    @abstractmethod
+    def _apply_local(self, op, args):
+        pass
+
+
+class RedisSet(ReplicatedCollection):
+    channel_prefix = 'redis-set'
+
+    def __init__(self, rdb, key_name, key_type=str, **kwargs):
+        self.key_type = key_type
+        self._set = set()
+        super(RedisSet, self).__init__(rdb, key_name, **kwargs)
 
     def __contains__(self, other):
         return other in self._set
 
+    def __iter__(self):
+        return iter(list(self._set))
+
+    def __len__(self):
+        return len(self._set)
+
     def add(self, key):
         if key in self._set:
             return
 
-        with self._lock:
-            self.rdb.sadd(self.key_name, key)
-            self._set.add(key)
-            self.rdb.publish(self.update_key_name, "A{}".format(key))
+        self._write('A', key)
 
     def remove(self, key):
         if key not in self._set:
             return
 
-        with self._lock:
-            self.rdb.srem(self.key_name, key)
-            self._set.remove(key)
-            self.rdb.publish(self.update_key_name, "R{}".format(key))
+        self._write('R', key)
 
-    def _listener(self):
-        for item in self._ps.listen():
-            if item["type"] != "message":
-                continue
-
-            with self._lock:
-                op, data = item["data"][0], item["data"][1:]
-
-                if op == "A":
-                    if data not in self._set:
-                        self._set.add(data)
-                elif op == "R":
-                    if data in self._set:
-                        self._set.remove(data)
+    def _load(self, pipe):
+        pipe.smembers(self.key_name)
+
+    def _replace(self, data):
+        self._set = {decode(key, self.key_type) for key in data}
+
+    def _apply_remote(self, pipe, op, args):
+        if op == 'A':
+            pipe.sadd(self.key_name, *args)
+        elif op == 'R':
+            pipe.srem(self.key_name, *args)
+
+    def _apply_local(self, op, args):
+        key = decode(str(args[0]), self.key_type)
+
+        if op == 'A':
+            self._set.add(key)
+        elif op == 'R':
+            self._set.discard(key)
+
+
+class RedisHash(ReplicatedCollection):
+    channel_prefix = 'redis-hash'
+
+    def __init__(self, rdb, key_name, key_type=str, value_type=str, **kwargs):
+        self.key_type = key_type
+        self.value_type = value_type
+        self._dict = {}
+        super(RedisHash, self).__init__(rdb, key_name, **kwargs)
+
+    def __contains__(self, key):
+        return key in self._dict
+
+    def __getitem__(self, key):
+        return self._dict[key]
+
+    def __iter__(self):
+        return iter(list(self._dict))
+
+    def __len__(self):
+        return len(self._dict)
+
+    def get(self, key, default=None):
+        return self._dict.get(key, default)
+
+    def set(self, key, value):
+        if self._dict.get(key) == value:
+            return
+
+        self._write('S', key, value)
+
+    def delete(self, key):
+        if key not in self._dict:
+            return
+
+        self._write('D', key)
+
+    def _load(self, pipe):
+        pipe.hgetall(self.key_name)
+
+    def _replace(self, data):
+        self._dict = {
+            decode(key, self.key_type): decode(value, self.value_type)
+            for key, value in data.items()
+        }
+
+    def _apply_remote(self, pipe, op, args):
+        if op == 'S':
+            pipe.hset(self.key_name, args[0], args[1])
+        elif op == 'D':
+            pipe.hdel(self.key_name, args[0])
+
+    def _apply_local(self, op, args):
+        key = decode(str(args[0]), self.key_type)
+
+        if op == 'S':
+            self._dict[key] = decode(str(args[1]), self.value_type)
+        elif op == 'D':
+            self._dict.pop(key, None)
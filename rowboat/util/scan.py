@@ -0,0 +1,64 @@
+from functools import cached_property
+from urllib.parse import unquote, urlparse
+
+from rowboat.constants import INVITE_LINK_RE, URL_RE
+from rowboat.util.zalgo import ZALGO_RE
+
+
+class MessageScan(object):
+    """
+    The tokenized contents of a message (links, invites, zalgo, blocked word
+    matches), each computed the first time it's needed. A scan is attached to
+    the event, so every plugin and config handling that event shares it.
+    """
+
+    def __init__(self, content):
+        self.content = content or ''
+        self._matches = {}
+        self._invite_info = {}
+
+    @classmethod
+    def of(cls, event):
+        scan = getattr(event, 'scan', None)
+        if scan is None or scan.content != (event.message.content or ''):
+            scan = event.scan = cls(event.message.content)
+        return scan
+
+    @cached_property
+    def zalgo_position(self):
+        match = ZALGO_RE.search(self.content)
+        return match.start() if match else None
+
+    @cached_property
+    def invites(self):
+        return [invite for _, invite in INVITE_LINK_RE.findall(unquote(self.content))]
+
+    @cached_property
+    def links(self):
+        return URL_RE.findall(self.content)
+
+    @cached_property
+    def domains(self):
+        # (link, lowercased domain) for each link the domain filter considers,
+        #  invites are left to the invite filter
+        domains = []
+        for link in self.links:
+            if INVITE_LINK_RE.match(link):
+                continue
+
+            try:
+                domains.append((link, urlparse(link).netloc.lower()))
+            except ValueError:
+                continue
+        return domains
+
+    def find_blocked(self, matcher):
+        # Configs with the same word lists share a matcher, and so a result
+        if id(matcher) not in self._matches:
+            self._matches[id(matcher)] = matcher.findall(self.content)
+        return self._matches[id(matcher)]
+
+    def get_invite_info(self, code, resolve):
+        if code not in self._invite_info:
+            self._invite_info[code] = resolve(code)
+        return self._invite_info[code]
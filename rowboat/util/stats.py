@@ -1,4 +1,5 @@
 import time
+from collections import defaultdict, deque
 from contextlib import contextmanager
 
 from datadog import statsd
@@ -10,6 +11,12 @@ def to_tags(obj=None, **kwargs):
     return ["{}:{}".format(k, v) for k, v in list(kwargs.items())]
 
 
+def increment(metric, value=1, tags=None):
+    if tags and isinstance(tags, dict):
+        tags = to_tags(tags)
+    statsd.increment(metric, value, tags=tags)
+
+
 @contextmanager
 def timed(metric, tags=None):
     start = time.time()
@@ -21,3 +28,32 @@ def timed(metric, tags=None):
         if tags and isinstance(tags, dict):
             tags = to_tags(tags)
         statsd.timing(metric, (time.time() - start) * 1000, tags=tags)
+
+
+class LatencyTracker(object):
+    """
+    Keeps the most recent `size` durations (in seconds) recorded for each key,
+    so percentiles can be answered in-process over recent calls.
+    """
+
+    def __init__(self, size=1000):
+        self._samples = defaultdict(lambda: deque(maxlen=size))
+
+    def __contains__(self, key):
+        return key in self._samples
+
+    def keys(self):
+        return list(self._samples.keys())
+
+    def record(self, key, duration):
+        self._samples[key].append(duration)
+
+    def percentiles(self, key, points=(50, 90, 99)):
+        samples = sorted(self._samples.get(key, ()))
+        if not samples:
+            return None
+
+        return {
+            point: samples[min(len(samples) - 1, int(len(samples) * point / 100))]
+            for point in points
+        }
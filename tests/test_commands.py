@@ -0,0 +1,109 @@
+import random
+from types import SimpleNamespace
+
+import pytest
+from disco.bot.bot import Bot
+from disco.bot.command import Command
+
+from rowboat.util.commands import CommandMatcher, compile_prefixes
+
+WORDS = ['ban', 'bans', 'b', 'kick', 'info', 'inf', 'infractions', 'mute', 'r', 'remind', 'role', 'roles', 'search']
+GROUPS = ['infractions', 'reminders', 'role', 'roles', 'archive', 'stars']
+
+OPTIONS = [
+    (False, ()),
+    (True, ()),
+    (False, ('!', )),
+    (False, ('!', '?')),
+    (True, ('!', )),
+]
+
+
+def make_bot(rand, commands):
+    me = SimpleNamespace(id=1, mention='<@1>')
+    bot = SimpleNamespace(commands=[], group_abbrev={}, command_matches_re=None, client=SimpleNamespace(state=SimpleNamespace(me=me)))
+    plugin = SimpleNamespace(bot=bot)
+
+    for _ in range(commands):
+        kwargs = {}
+        if rand.random() < 0.5:
+            kwargs['group'] = rand.choice(GROUPS)
+        if rand.random() < 0.2:
+            kwargs['aliases'] = rand.sample(WORDS, 2)
+
+        if rand.random() < 0.05:
+            bot.commands.append(Command(plugin, lambda event: None, r'\d+ ?' + rand.choice(WORDS), is_regex=True))
+        else:
+            trigger = rand.choice(WORDS)
+            if rand.random() < 0.2:
+                trigger += ' ' + rand.choice(WORDS)
+            bot.commands.append(Command(plugin, lambda event: None, trigger, **kwargs))
+
+    bot.group_abbrev = Bot.compute_group_abbrev(bot, {command.group for command in bot.commands if command.group})
+    Bot.compute_command_matches_re(bot)
+    return bot
+
+
+def make_message(content, is_dm=False):
+    return SimpleNamespace(
+        content=content,
+        guild=None,
+        channel=SimpleNamespace(is_dm=is_dm),
+        mention_everyone=False,
+        is_mentioned=lambda user: user.mention in content)
+
+
+def random_message(rand):
+    parts = [rand.choice(WORDS + GROUPS + ['', '123', 'x']) for _ in range(rand.randint(0, 4))]
+    content = ' '.join(parts)
+    if rand.random() < 0.5:
+        content = rand.choice(['!', '?', '!!', '']) + content
+    if rand.random() < 0.3:
+        content = rand.choice(['<@1> ', '<@1>', '<@2> ']) + content
+    if rand.random() < 0.1:
+        content = content.upper()
+    return make_message(content, is_dm=rand.random() < 0.2)
+
+
+@pytest.fixture(scope='module')
+def bot():
+    return make_bot(random.Random(0), 60)
+
+
+def test_compile_prefixes():
+    assert compile_prefixes(None) == ()
+    assert compile_prefixes(SimpleNamespace(prefix='!', prefixes=[])) == ('!', )
+    assert compile_prefixes(SimpleNamespace(prefix=None, prefixes=['!', '?'])) == ('!', '?')
+
+
+@pytest.mark.parametrize('require_mention,prefixes', OPTIONS)
+def test_matches_bot(bot, require_mention, prefixes):
+    matcher = CommandMatcher(bot)
+    rand = random.Random(1)
+
+    for _ in range(3000):
+        msg = random_message(rand)
+        expected = [command for command, _ in Bot.get_commands_for_message(bot, require_mention, {}, list(prefixes), msg)]
+        actual = [command for command, _ in matcher.get_commands_for_message(require_mention, prefixes, msg)]
+        assert expected == actual, msg.content
+
+
+def test_plain_messages_ignored(bot):
+    # Without a prefix or a required mention nothing is a command, DMs included
+    matcher = CommandMatcher(bot)
+    assert matcher.get_commands_for_message(False, (), make_message('kick')) == []
+    assert matcher.get_commands_for_message(False, (), make_message('kick', is_dm=True)) == []
+
+
+def test_rebuilds_with_commands(bot):
+    matcher = CommandMatcher(bot)
+    assert matcher.get_commands_for_message(False, ('!', ), make_message('!unusedtrigger')) == []
+
+    plugin = SimpleNamespace(bot=bot)
+    bot.commands.append(Command(plugin, lambda event: None, 'unusedtrigger'))
+    try:
+        Bot.compute_command_matches_re(bot)
+        assert [command.triggers for command, _ in matcher.get_commands_for_message(False, ('!', ), make_message('!unusedtrigger'))] == [['unusedtrigger']]
+    finally:
+        bot.commands.pop()
+        Bot.compute_command_matches_re(bot)
@@ -0,0 +1,45 @@
+import random
+from collections import namedtuple
+
+from rowboat.util.levels import LevelIndex
+
+Member = namedtuple('Member', ('id', 'roles'))
+
+
+def loop(levels, member):
+    # How CorePlugin.get_level worked out a member's level before the index
+    user_level = 0
+    for oid in member.roles:
+        if oid in levels and levels[oid] > user_level:
+            user_level = levels[oid]
+
+    if member.id in levels:
+        user_level = levels[member.id]
+    return user_level
+
+
+def test_user_override():
+    index = LevelIndex({1: 100, 5000: 10})
+    assert index.get_level(Member(5000, [1])) == 10
+    assert index.get_level(Member(5001, [1])) == 100
+
+
+def test_no_levels():
+    assert LevelIndex(None).get_level(Member(5000, [1, 2])) == 0
+
+
+def test_matches_loop():
+    rand = random.Random(0)
+    guild_roles = list(range(1, 250))
+
+    for _ in range(20):
+        levels = {role: rand.choice((-1, 10, 50, 100)) for role in rand.sample(guild_roles, 10)}
+        levels[1000 + rand.randint(0, 50)] = rand.choice((0, 10, 100))
+
+        # A small index, so it's cleared part way through
+        index = LevelIndex(levels, max_size=16)
+        role_sets = [rand.sample(guild_roles, rand.randint(0, 30)) for _ in range(40)]
+
+        for _ in range(500):
+            member = Member(1000 + rand.randint(0, 100), rand.choice(role_sets))
+            assert index.get_level(member) == loop(levels, member), (levels, member)
@@ -0,0 +1,54 @@
+import random
+import re
+
+import pytest
+
+from rowboat.util.matcher import MultiMatcher
+
+ALPHABET = 'abcAB_1-'
+SEPARATORS = [' ', '', '-', '_', '.', 'x', '1', '\n']
+
+
+def old_regex(tokens, words):
+    # The alternation CensorSubConfig.blocked_re used to compile
+    alternatives = list(map(re.escape, tokens)) + ['\\b{}\\b'.format(re.escape(k)) for k in words]
+    if not alternatives:
+        return None
+    return re.compile('({})'.format('|'.join(alternatives)), re.I)
+
+
+@pytest.mark.parametrize('tokens,words,content,expected', [
+    (['bad'], [], 'this is BADness', True),
+    ([], ['bad'], 'this is badness', False),
+    ([], ['bad'], 'this is bad.', True),
+    ([], ['bad'], 'bad_word', False),
+    ([], ['a-b'], 'x a-b y', True),
+    ([], [], 'anything', False),
+])
+def test_search(tokens, words, content, expected):
+    assert MultiMatcher(tokens, words).search(content) is expected
+
+
+def test_matches_old_regex():
+    # Short patterns over a small alphabet, so messages often hit (and narrowly
+    #  miss) the word boundaries
+    rand = random.Random(0)
+
+    def random_word(low, high):
+        return ''.join(rand.choice(ALPHABET) for _ in range(rand.randint(low, high)))
+
+    for _ in range(3000):
+        tokens = [random_word(1, 4) for _ in range(rand.randint(0, 3))]
+        words = [random_word(1, 4) for _ in range(rand.randint(0, 5))]
+        patterns = tokens + words
+
+        parts = []
+        for _ in range(rand.randint(0, 6)):
+            parts.append(rand.choice(patterns) if patterns and rand.random() < 0.5 else random_word(0, 4))
+            parts.append(rand.choice(SEPARATORS))
+        content = ''.join(parts)
+
+        regex = old_regex(tokens, words)
+        expected = bool(regex and regex.search(content))
+
+        assert MultiMatcher(tokens, words).search(content) == expected, (tokens, words, content)